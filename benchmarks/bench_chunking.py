@@ -0,0 +1,77 @@
+"""Show that with chunking, storing a new version of a large file costs the size
+of the edit rather than the size of the file.
+
+Usage: python benchmarks/bench_chunking.py [size in MB] [versions]
+
+A file of random bytes is committed, then edited a few times by overwriting,
+inserting and deleting a few bytes. Every version is committed without and
+with 'core.chunkThreshold', and the growth of the object store is reported.
+"""
+import os
+import random
+import sys
+import tempfile
+
+from ugit import base, data
+
+from synthetic import timed
+
+
+def _store_size() -> int:
+    size = 0
+    for root, _, filenames in os.walk(f"{data.GIT_DIR}/objects"):
+        for filename in filenames:
+            size += os.path.getsize(f"{root}/{filename}")
+    return size
+
+
+def _edit(content: bytes, rng: random.Random) -> bytes:
+    pos = rng.randrange(len(content))
+    edit = rng.choice(("overwrite", "insert", "delete"))
+    if edit == "overwrite":
+        return content[:pos] + os.urandom(100) + content[pos + 100:]
+    if edit == "insert":
+        return content[:pos] + os.urandom(100) + content[pos:]
+    return content[:pos] + content[pos + 100:]
+
+
+def run(size: int, versions: int, chunk_threshold: int):
+    """
+    Yield (seconds, store growth in bytes) of every committed version.
+    """
+    rng = random.Random(0)
+    content = random.Random(1).randbytes(size)
+    base.init()
+    if chunk_threshold:
+        data.set_config("core.chunkThreshold", str(chunk_threshold))
+    for _ in range(versions):
+        with open("large.bin", "wb") as f:
+            f.write(content)
+        before = _store_size()
+        seconds, _ = timed(base.commit, "version")
+        yield seconds, _store_size() - before
+        content = _edit(content, rng)
+
+
+def main():
+    size = int(float(sys.argv[1]) * (1 << 20)) if len(sys.argv) > 1 else 64 << 20
+    versions = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{'version':>8} {'plain':>10} {'growth':>10} {'chunked':>10} {'growth':>10}")
+    results = []
+    cwd = os.getcwd()
+    for chunk_threshold in (0, 1 << 20):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                results.append(list(run(size, versions, chunk_threshold)))
+            finally:
+                os.chdir(cwd)
+    for i, ((plain, plain_growth), (chunked, chunked_growth)) in enumerate(zip(*results)):
+        print(
+            f"{i:>8} {plain:>9.2f}s {plain_growth / 1024:>8.0f}KB "
+            f"{chunked:>9.2f}s {chunked_growth / 1024:>8.0f}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compare status with and without the filesystem monitor.
+
+Usage: python benchmarks/bench_fsmonitor.py [file counts...] [--poll]
+
+A synthetic workspace is committed, then status runs after a few files
+change: first scanning the workspace, then with 'ugit fsmonitor' running
+in the background (inotify, or polling with --poll).
+"""
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+
+from ugit import base, cli
+
+from synthetic import file_paths, fsmonitor_daemon, modify, populate, timed
+
+CHANGES = 5
+REPEAT = 5
+
+
+def _status_seconds(paths, rng) -> float:
+    samples = []
+    for _ in range(REPEAT):
+        modify(paths, CHANGES, rng)
+        seconds, _ = timed(cli.status, argparse.Namespace())
+        samples.append(seconds)
+    return min(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark status with the filesystem monitor")
+    parser.add_argument("sizes", type=int, nargs="*", default=[2000, 20000])
+    parser.add_argument("--poll", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'scan':>10} {'fsmonitor':>10}")
+    cwd = os.getcwd()
+    for n_files in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                rng = random.Random(0)
+                paths = file_paths(n_files, depth=3)
+                populate(paths, 200, rng)
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    base.init()
+                    base.commit("initial")
+                    scan = _status_seconds(paths, rng)
+                    with fsmonitor_daemon(args.poll):
+                        # The first query scans, the next ones get the changes
+                        cli.status(argparse.Namespace())
+                        monitored = _status_seconds(paths, rng)
+            finally:
+                os.chdir(cwd)
+        print(f"{n_files:>8} {scan * 1000:>8.1f}ms {monitored * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
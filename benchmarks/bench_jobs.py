@@ -0,0 +1,47 @@
+"""Show how write_tree, status and read_tree scale with the number of jobs.
+
+Usage: python benchmarks/bench_jobs.py [n_files] [file_size]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from ugit import base, data
+
+from synthetic import file_paths, populate, timed
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    file_size = int(sys.argv[2]) if len(sys.argv) > 2 else 256 << 10
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            base.init()
+            populate(file_paths(n_files, depth=1), file_size, random.Random(0), binary=True)
+            print(f"{n_files} files of {file_size} bytes, {os.cpu_count()} cpus")
+            print(f"{'jobs':>5} {'write_tree':>11} {'status':>9} {'read_tree':>10}")
+            tree = None
+            for jobs in (1, 2, 4, 8, 16):
+                base.JOBS = jobs
+                # Start from an empty index and object database every time
+                shutil.rmtree(f"{data.GIT_DIR}/objects")
+                os.makedirs(f"{data.GIT_DIR}/objects")
+                if os.path.exists(f"{data.GIT_DIR}/index"):
+                    os.remove(f"{data.GIT_DIR}/index")
+                t_write, oid = timed(base.write_tree)
+                assert tree in (None, oid), "Parallel output differs from serial"
+                tree = oid
+                os.remove(f"{data.GIT_DIR}/index")
+                t_status, _ = timed(base.write_tree, ".", False)
+                t_read, _ = timed(base.read_tree, tree)
+                print(f"{jobs:>5} {t_write:>10.3f}s {t_status:>8.3f}s {t_read:>9.3f}s")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Compare checkout and status of the whole workspace with a sparse checkout.
+
+Usage: python benchmarks/bench_sparse.py [file counts...] [--cone directory]
+
+A synthetic workspace is committed twice, with changes all over it, then
+checkout goes back and forth between the two commits and status runs after a
+few files of the cone change: first with everything checked out, then with
+only the cone.
+"""
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+
+from ugit import base, cli
+
+from synthetic import file_paths, modify, populate, timed
+
+REPEAT = 5
+
+
+def _workspace_files() -> int:
+    return sum(
+        len(filenames) for root, _, filenames in os.walk(".") if not root.startswith("./.ugit")
+    )
+
+
+def _measure(commits, paths, rng):
+    """
+    Return (checkout seconds, files in the workspace, status seconds).
+    """
+    checkouts = []
+    for i in range(REPEAT):
+        seconds, _ = timed(base.checkout, commits[i % 2])
+        checkouts.append(seconds)
+    base.checkout("main")
+    statuses = []
+    for _ in range(REPEAT):
+        modify(paths, 5, rng)
+        seconds, _ = timed(cli.status, argparse.Namespace())
+        statuses.append(seconds)
+    return min(checkouts), _workspace_files(), min(statuses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a sparse checkout")
+    parser.add_argument("sizes", type=int, nargs="*", default=[2000, 20000])
+    parser.add_argument("--cone", default="d0/d1", help="directory of the sparse checkout")
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'mode':>7} {'checkout':>10} {'on disk':>8} {'status':>10}")
+    cwd = os.getcwd()
+    for n_files in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                rng = random.Random(0)
+                paths = file_paths(n_files, depth=3)
+                cone = [path for path in paths if path.startswith(f"{args.cone}/")]
+                assert cone, f"No file in {args.cone}"
+                populate(paths, 200, rng)
+                results = []
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    base.init()
+                    first = base.commit("first")
+                    modify(paths, n_files // 10, rng)
+                    modify(cone, len(cone) // 10, rng)
+                    commits = [first, base.commit("second")]
+                    results.append(("full", _measure(commits, cone, rng)))
+                    base.commit("status changes")
+                    base.set_sparse_checkout([args.cone])
+                    results.append(("sparse", _measure(commits, cone, rng)))
+            finally:
+                os.chdir(cwd)
+        for mode, (checkout, on_disk, status) in results:
+            print(
+                f"{n_files:>8} {mode:>7} {checkout * 1000:>8.1f}ms {on_disk:>8} "
+                f"{status * 1000:>8.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
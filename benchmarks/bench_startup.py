@@ -0,0 +1,113 @@
+"""Measure the cold start of ugit commands against a bare interpreter.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--target MS]
+
+Every command runs in a fresh interpreter. The wall time of a trivial
+command ('ugit branch') must stay within the target above 'python -c pass',
+the script exits with 1 otherwise. The import time of the ugit modules,
+from 'python -X importtime', shows where a regression comes from.
+Bytecode is cached in a temporary directory, like a normal installation.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from ugit import base
+
+# Startup overhead allowed for a trivial command on top of the interpreter
+DEFAULT_TARGET_MS = 35
+
+RUN_UGIT = "import sys; from ugit.cli import main; sys.argv[0] = 'ugit'; main()"
+COMMANDS = [
+    ["branch"],
+    ["config", "core.jobs"],
+    ["cat-file", "--batch-check"],
+    ["log"],
+    ["status"],
+]
+
+
+def run(args, env) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args], env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True
+    )
+    return time.perf_counter() - start
+
+
+def median_time(args, env, runs: int) -> float:
+    return statistics.median(run(args, env) for _ in range(runs))
+
+
+def ugit_import_time(command, env) -> float:
+    """
+    Seconds spent importing ugit modules and what they import, per -X importtime.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", RUN_UGIT, *command],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Top level imports of ugit, the cumulative time includes their dependencies
+        if name.startswith(" ugit"):
+            total += int(cumulative)
+    return total / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of ugit commands")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET_MS, help="milliseconds")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=f"{tmp}/pycache")
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        os.chdir(tmp)
+        try:
+            base.init()
+            with open("file.txt", "w") as f:
+                f.write("content\n")
+            base.commit("initial")
+
+            # Fill the bytecode cache
+            for command in COMMANDS:
+                run(["-c", RUN_UGIT, *command], env)
+
+            interpreter = median_time(["-c", "pass"], env, args.runs)
+            print(f"{'python -c pass':>28} {interpreter * 1000:>7.1f}ms")
+            print(f"{'command':>28} {'wall':>9} {'overhead':>9} {'imports':>9}")
+            overheads = {}
+            for command in COMMANDS:
+                wall = median_time(["-c", RUN_UGIT, *command], env, args.runs)
+                overheads[command[0]] = wall - interpreter
+                imports = ugit_import_time(command, env)
+                print(
+                    f"{'ugit ' + ' '.join(command):>28} {wall * 1000:>7.1f}ms "
+                    f"{(wall - interpreter) * 1000:>7.1f}ms {imports * 1000:>7.1f}ms"
+                )
+        finally:
+            os.chdir(cwd)
+
+    overhead = overheads["branch"] * 1000
+    if overhead > args.target:
+        print(f"'ugit branch' starts {overhead:.1f}ms slower than python, target {args.target:g}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Compare two result files of benchmarks/run.py and fail on regressions.
+
+Usage: python benchmarks/compare.py <baseline.json> <current.json>
+           [--threshold 0.1] [--min-delta 0.001] [--stat min]
+
+A scenario regresses when it is slower than the baseline by more than the
+threshold (a fraction) and by more than --min-delta seconds, so the noise of
+sub-millisecond scenarios is not reported. Exits with 1 on regressions, and
+with 2 if the runs are not comparable because their repositories differ.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline: dict, current: dict, threshold: float, min_delta: float, stat: str):
+    """
+    Yield (scenario, baseline seconds, current seconds, relative change, regressed).
+    """
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name][stat]
+        after = result[stat]
+        change = (after - before) / before if before else 0.0
+        yield name, before, after, change, change > threshold and after - before > min_delta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 is 10%%")
+    parser.add_argument(
+        "--min-delta", type=float, default=0.001, help="slowdowns of fewer seconds are ignored"
+    )
+    parser.add_argument("--stat", choices=("min", "median"), default="median")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if (baseline["shape"], baseline["seed"]) != (current["shape"], current["seed"]):
+        print("The runs used differently shaped repositories, not comparing", file=sys.stderr)
+        sys.exit(2)
+
+    regressions = []
+    print(f"{'scenario':>12} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, before, after, change, regressed in compare(
+        baseline, current, args.threshold, args.min_delta, args.stat
+    ):
+        mark = "  REGRESSION" if regressed else ""
+        print(f"{name:>12} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms {change:>+7.1%}{mark}")
+        if regressed:
+            regressions.append(name)
+
+    if regressions:
+        print(f"{len(regressions)} scenarios slower than the {args.threshold:.0%} threshold")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
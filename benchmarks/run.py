@@ -0,0 +1,191 @@
+"""Time the main ugit operations on a synthetic repository and print the results as JSON.
+
+Usage: python benchmarks/run.py [shape options] [--repeat N] [--jobs N]
+           [--output FILE] [scenario ...]
+
+Every scenario runs in the same process, with the in-memory caches dropped
+before each repetition to match a fresh command. Compare two result files
+with benchmarks/compare.py.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+
+from ugit import annotate, base, cli, commit_graph, data, pack
+
+from synthetic import Shape, add_shape_arguments, file_paths, generate, modify, shape_from_args, timed
+
+
+class Context:
+    """
+    The generated repository: its shape, interesting commits and a random
+    generator for the changes made by scenarios.
+    """
+
+    def __init__(self, shape: Shape, refs, seed: int):
+        self.shape = shape
+        self.refs = refs
+        self.paths = file_paths(shape.files, shape.depth)
+        self.rng = random.Random(seed + 1)
+
+
+def _drop_caches():
+    base._object_cache = None
+    annotate._cache = None
+    commit_graph._invalidate()
+    pack._get_packs(reload=True)
+
+
+def _clean_workspace():
+    """
+    Bring the workspace back to HEAD, whatever a scenario left in it.
+    """
+    data.delete_ref("MERGE_HEAD", deref=False)
+    HEAD = base.get_oid("@")
+    base.read_tree(base.get_commit(HEAD).tree, base_tree=base.write_tree())
+
+
+def bench_init(ctx: Context) -> float:
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            seconds, _ = timed(base.init)
+        finally:
+            os.chdir(cwd)
+    return seconds
+
+
+def bench_status(ctx: Context) -> float:
+    modify(ctx.paths, ctx.shape.changes, ctx.rng)
+    seconds, _ = timed(cli.status, argparse.Namespace())
+    _clean_workspace()
+    return seconds
+
+
+def bench_diff(ctx: Context) -> float:
+    modify(ctx.paths, ctx.shape.changes, ctx.rng)
+    seconds, _ = timed(cli._diff, argparse.Namespace(commit=base.get_oid("@")))
+    _clean_workspace()
+    return seconds
+
+
+def bench_checkout(ctx: Context) -> float:
+    seconds, _ = timed(base.checkout, ctx.refs["middle"])
+    base.checkout("main")
+    return seconds
+
+
+def bench_log(ctx: Context) -> float:
+    seconds, _ = timed(cli.log, cli.parse_args(["log", ctx.refs["main"]]))
+    return seconds
+
+
+def bench_annotate(ctx: Context) -> float:
+    seconds, _ = timed(annotate.annotate, ctx.refs["main"], ctx.paths[0])
+    return seconds
+
+
+def bench_merge_base(ctx: Context) -> float:
+    seconds, _ = timed(base.get_merge_base, ctx.refs["main"], ctx.refs["feature"])
+    return seconds
+
+
+def bench_merge(ctx: Context) -> float:
+    seconds, _ = timed(base.merge, ctx.refs["feature"])
+    _clean_workspace()
+    return seconds
+
+
+def bench_commit(ctx: Context) -> float:
+    modify(ctx.paths, ctx.shape.changes, ctx.rng)
+    seconds, _ = timed(base.commit, "benchmark")
+    # Later repetitions start from the same commit
+    base.reset(ctx.refs["main"])
+    _clean_workspace()
+    return seconds
+
+
+# Scenarios that modify the repository put it back as they found it
+SCENARIOS = {
+    "init": bench_init,
+    "status": bench_status,
+    "diff": bench_diff,
+    "checkout": bench_checkout,
+    "log": bench_log,
+    "annotate": bench_annotate,
+    "merge-base": bench_merge_base,
+    "merge": bench_merge,
+    "commit": bench_commit,
+}
+
+
+def run(shape: Shape, seed: int, repeat: int, names) -> dict:
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            generate_seconds, refs = timed(generate, shape, seed)
+            ctx = Context(shape, refs, seed)
+            results = {}
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                for name in names:
+                    samples = []
+                    for _ in range(repeat):
+                        _drop_caches()
+                        samples.append(SCENARIOS[name](ctx))
+                    results[name] = {
+                        "min": min(samples),
+                        "median": statistics.median(samples),
+                        "samples": samples,
+                    }
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "shape": shape._asdict(),
+        "seed": seed,
+        "repeat": repeat,
+        "jobs": base.JOBS or 1,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "generate_seconds": generate_seconds,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ugit on a synthetic repository")
+    add_shape_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker threads")
+    parser.add_argument("-o", "--output", help="write the JSON results to a file")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}, all by default")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.jobs:
+        base.JOBS = args.jobs
+    names = args.scenarios or list(SCENARIOS)
+    report = run(shape_from_args(args), args.seed, args.repeat, names)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for name, result in report["results"].items():
+        print(f"{name:>12} {result['median'] * 1000:>9.1f}ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Build synthetic ugit repositories of a configurable shape for the benchmarks.
+
+Usage: python benchmarks/synthetic.py <directory> [--files N] [--depth N]
+           [--file-size BYTES] [--commits N] [--branches N] [--changes N] [--seed N]
+"""
+import argparse
+import contextlib
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+from collections import namedtuple
+from typing import Dict, List
+
+from ugit import base, fsmonitor
+
+# files: files in the workspace, spread over directories nested depth levels deep
+# file_size: average size of a file in bytes
+# commits: length of the history, merges included
+# branches: topic branches forked from and merged back into main
+# changes: files modified by each commit
+Shape = namedtuple(
+    "Shape",
+    ["files", "depth", "file_size", "commits", "branches", "changes"],
+    defaults=(2000, 3, 1024, 50, 4, 5),
+)
+FILES_PER_DIR = 100
+RUN_UGIT = "import sys; from ugit.cli import main; sys.argv[0] = 'ugit'; main()"
+# Commits made on each topic branch, and on the unmerged 'feature' branch
+BRANCH_LENGTH = 3
+
+
+def add_shape_arguments(parser: argparse.ArgumentParser):
+    defaults = Shape()
+    for field in Shape._fields:
+        parser.add_argument(
+            f"--{field.replace('_', '-')}", type=int, default=getattr(defaults, field)
+        )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def shape_from_args(args: argparse.Namespace) -> Shape:
+    return Shape(*(getattr(args, field) for field in Shape._fields))
+
+
+def timed(func, *args):
+    """
+    Return (seconds, result) of func(*args).
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def file_paths(n_files: int, depth: int, files_per_dir: int = FILES_PER_DIR) -> List[str]:
+    """
+    Paths of n_files spread over directories depth levels deep, with as many
+    subdirectories per directory as needed to keep files_per_dir in each leaf.
+    """
+    n_dirs = math.ceil(n_files / files_per_dir)
+    fanout = max(2, math.ceil(n_dirs ** (1 / depth))) if depth else 1
+    paths = []
+    for i in range(n_files):
+        directory = i // files_per_dir
+        parts = []
+        for _ in range(depth):
+            directory, digit = divmod(directory, fanout)
+            parts.append(f"d{digit}")
+        paths.append("/".join([*reversed(parts), f"f{i}.txt"]))
+    return paths
+
+
+def _line(rng: random.Random) -> str:
+    return f"{rng.getrandbits(64):016x} {rng.getrandbits(64):016x}\n"
+
+
+def _text(rng: random.Random, size: int) -> str:
+    # Sizes vary between half and one and a half times the average
+    size = rng.randint(size // 2, size * 3 // 2)
+    return "".join(_line(rng) for _ in range(max(1, size // 34)))
+
+
+def populate(paths: List[str], file_size: int, rng: random.Random, binary: bool = False):
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if binary:
+            with open(path, "wb") as f:
+                f.write(os.urandom(file_size))
+        else:
+            with open(path, "w") as f:
+                f.write(_text(rng, file_size))
+
+
+def modify(paths: List[str], count: int, rng: random.Random):
+    """
+    Replace a random line in count random files.
+    """
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(path) as f:
+            lines = f.readlines()
+        lines[rng.randrange(len(lines))] = _line(rng)
+        with open(path, "w") as f:
+            f.writelines(lines)
+
+
+@contextlib.contextmanager
+def fsmonitor_daemon(poll: bool = False):
+    """
+    Run 'ugit fsmonitor' for the current directory in the background.
+    """
+    command = [sys.executable, "-c", RUN_UGIT, "fsmonitor"] + (["--poll"] if poll else [])
+    daemon = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(fsmonitor.socket_path()):
+            assert daemon.poll() is None, "fsmonitor did not start"
+            time.sleep(0.05)
+        yield
+    finally:
+        fsmonitor.stop()
+        daemon.wait()
+
+
+def _commit_change(paths: List[str], shape: Shape, rng: random.Random, message: str) -> str:
+    modify(paths, shape.changes, rng)
+    return base.commit(message)
+
+
+def generate(shape: Shape, seed: int = 0) -> Dict[str, str]:
+    """
+    Create a repository of the given shape in the current directory. Topic
+    branches are forked at regular intervals and merged back into main after
+    main itself moves on, so the history has real three-way merges. A last
+    branch, 'feature', forks halfway through the history and stays unmerged.
+    Return the oids of interesting commits: 'root', 'middle', 'main' and 'feature'.
+    """
+    rng = random.Random(seed)
+    paths = file_paths(shape.files, shape.depth)
+
+    base.init()
+    populate(paths, shape.file_size, rng)
+    root = base.commit("initial")
+
+    interval = shape.commits // (shape.branches + 1)
+    forks = [interval * (i + 1) for i in range(shape.branches)]
+    n_commits = 1
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while n_commits < shape.commits:
+            if forks and n_commits >= forks[0]:
+                topic = f"topic{shape.branches - len(forks)}"
+                forks.pop(0)
+                base.create_branch(topic, base.get_oid("@"))
+                base.checkout(topic)
+                for i in range(BRANCH_LENGTH):
+                    _commit_change(paths, shape, rng, f"{topic} {i}")
+                base.checkout("main")
+                _commit_change(paths, shape, rng, f"main {n_commits}")
+                base.merge(base.get_oid(topic))
+                base.commit(f"Merge {topic}")
+                n_commits += BRANCH_LENGTH + 2
+            else:
+                _commit_change(paths, shape, rng, f"main {n_commits}")
+                n_commits += 1
+
+        main = base.get_oid("main")
+        first_parents = []
+        oid = main
+        while oid:
+            first_parents.append(oid)
+            parents = base.get_commit(oid).parents
+            oid = parents[0] if parents else None
+        middle = first_parents[len(first_parents) // 2]
+
+        base.create_branch("feature", middle)
+        base.checkout("feature")
+        for i in range(BRANCH_LENGTH):
+            _commit_change(paths, shape, rng, f"feature {i}")
+        feature = base.get_oid("@")
+        base.checkout("main")
+
+    return {"root": root, "middle": middle, "main": main, "feature": feature}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a synthetic ugit repository")
+    parser.add_argument("directory")
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.directory)
+    os.chdir(args.directory)
+    seconds, refs = timed(generate, shape_from_args(args), args.seed)
+    for name, oid in refs.items():
+        print(f"{name:>8} {oid}")
+    print(f"Generated in {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import pytest
+
+from ugit import annotate, base, commit_graph, pack
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """
+    An empty repository in a temporary directory, which is the working directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    # Every repository is '.ugit' relative to its workspace, start without
+    # what the previous test loaded as a new process would
+    monkeypatch.setattr(commit_graph, "_graph", None)
+    monkeypatch.setattr(pack, "_packs", None)
+    monkeypatch.setattr(annotate, "_cache", None)
+    monkeypatch.setattr(base, "_object_cache", None)
+    base.init()
+    return tmp_path
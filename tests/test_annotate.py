@@ -0,0 +1,25 @@
+from ugit import annotate, base
+from ugit.annotate import Origin
+
+
+def _commit(path: str, content: str) -> str:
+    with open(path, "w") as f:
+        f.write(content)
+    return base.commit(path)
+
+
+def test_annotations_are_shared_by_later_commits(repo):
+    first = _commit("f", "a\nb\n")
+    second = _commit("g", "g\n")
+    third = _commit("f", "a\nb\nc\n")
+    cache = annotate.get_cache()
+
+    expected = [Origin(first, 0), Origin(first, 1)]
+    assert annotate.annotate(second, "f") == expected
+    assert cache.hits == 0
+    # The file is the same in both commits
+    assert annotate.annotate(first, "f") == expected
+    assert cache.hits == 1
+    # The walk from a later version stops at the annotated one
+    assert annotate.annotate(third, "f") == expected + [Origin(third, 2)]
+    assert cache.hits == 2
@@ -0,0 +1,27 @@
+from ugit import diff
+
+
+def test_split_lines_only_at_newlines():
+    assert diff.split_lines(b"") == []
+    assert diff.split_lines(b"a\rb\x0bc\x1cd\n") == [b"a\rb\x0bc\x1cd\n"]
+    assert diff.split_lines(b"a\r\nb") == [b"a\r\n", b"b"]
+
+
+def test_unified_diff_keeps_carriage_returns_in_lines():
+    patch = b"".join(diff.unified_diff(b"a\rb\nc\n", b"a\rb\nd\n", b"a/f", b"b/f"))
+    assert patch == (
+        b"--- a/f\n"
+        b"+++ b/f\n"
+        b"@@ -1,2 +1,2 @@\n"
+        b" a\rb\n"
+        b"-c\n"
+        b"+d\n"
+    )
+
+
+def test_merge_keeps_carriage_returns_in_lines():
+    base = [b"a\rb\n", b"c\n", b"d\n"]
+    ours = [b"a\rB\n", b"c\n", b"d\n"]
+    theirs = [b"a\rb\n", b"c\n", b"D\n"]
+    merged = diff.merge3(*(diff.split_lines(b"".join(lines)) for lines in (base, ours, theirs)))
+    assert merged == b"a\rB\nc\nD\n"
@@ -0,0 +1,31 @@
+import os
+
+from ugit import base, data, gc, pack
+
+
+def _age(path: str):
+    os.utime(path, (0, 0))
+
+
+def test_rewriting_a_loose_object_keeps_it_from_gc(repo):
+    oid = data.hash_object(b"dangling")
+    _age(data._object_path(oid))
+    assert data.hash_object(b"dangling") == oid
+    gc.gc(grace=3600)
+    assert data.object_exists(oid)
+
+
+def test_rewriting_a_packed_object_keeps_its_pack_from_gc(repo):
+    oid = data.hash_object(b"dangling")
+    name = pack.repack([oid])
+    _age(f"{name}.pack")
+    with open("f", "wb") as f:
+        f.write(b"dangling")
+    assert data.hash_file("f") == oid
+    # Something reachable, so that gc writes a new pack and drops the old one
+    os.remove("f")
+    with open("g", "wb") as f:
+        f.write(b"reachable")
+    base.commit("g")
+    gc.gc(grace=3600, repack=True)
+    assert data.object_exists(oid)
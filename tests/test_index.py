@@ -0,0 +1,32 @@
+import os
+import time
+
+from ugit import base, data, index
+
+
+def _lookup(path: str) -> str:
+    return index.read_index().lookup(path, os.lstat(path))
+
+
+def test_racy_entry_is_clean_once_confirmed(repo):
+    with open("f", "w") as f:
+        f.write("f\n")
+    past = 10**18
+    os.utime("f", ns=(past, past))
+    base.write_tree(save_blobs=False)
+    # The index written in the same timestamp tick as the file
+    os.utime(f"{data.GIT_DIR}/index", ns=(past, past))
+    assert _lookup("f") is None
+
+    base.write_tree(save_blobs=False)
+    assert _lookup("f") == data.hash_file("f", write=False)
+
+
+def test_entry_modified_after_the_index_is_hashed_again(repo):
+    with open("f", "w") as f:
+        f.write("f\n")
+    future = time.time_ns() + 10**12
+    os.utime("f", ns=(future, future))
+    base.write_tree(save_blobs=False)
+    assert index.read_index().entries["f"].size == -1
+    assert _lookup("f") is None
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from ugit import base, cli
+
+
+def _log(capsys, *argv) -> str:
+    args = cli.parse_args(["log", *argv])
+    args.func(args)
+    return capsys.readouterr().out
+
+
+@pytest.fixture
+def history(repo):
+    with open("f", "w") as f:
+        f.write("f\n")
+    base.commit("add f")
+    os.remove("f")
+    base.commit("remove f")
+
+
+def test_log_rejects_an_unknown_revision(history, capsys):
+    with pytest.raises(AssertionError, match="mastr"):
+        _log(capsys, "mastr")
+
+
+def test_log_takes_removed_paths_after_double_dash(history, capsys):
+    out = _log(capsys, "--", "f")
+    assert "add f" in out and "remove f" in out
+    out = _log(capsys, "main", "--", "f")
+    assert "add f" in out and "remove f" in out
+
+
+def test_log_rejects_a_negative_count(history, capsys):
+    with pytest.raises(SystemExit):
+        cli.parse_args(["log", "-n", "-1"])
+    assert "add f" not in _log(capsys, "-n", "1")
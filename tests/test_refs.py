@@ -0,0 +1,50 @@
+import os
+
+from ugit import base, data
+
+
+def _check_packed_first(monkeypatch, ref: str, expected: str):
+    """
+    Make removing the loose file of ref check that packed-refs already has its
+    new value.
+    """
+    remove = os.remove
+
+    def checked_remove(path):
+        if path == f"{data.GIT_DIR}/{ref}":
+            assert not os.path.exists(f"{data.GIT_DIR}/packed-refs.lock")
+            assert data._get_packed_refs().get(ref) == expected
+        remove(path)
+
+    monkeypatch.setattr(os, "remove", checked_remove)
+
+
+def _commit_shadowed_branch() -> str:
+    """
+    Create branch 'other', both in packed-refs and as a loose ref.
+    """
+    with open("f", "w") as f:
+        f.write("f\n")
+    oid = base.commit("f")
+    base.create_branch("other", oid)
+    data.pack_refs()
+    base.create_branch("other", oid)
+    assert os.path.isfile(f"{data.GIT_DIR}/refs/heads/other")
+    assert data._get_packed_refs().get("refs/heads/other") == oid
+    return oid
+
+
+def test_transaction_commits_packed_refs_before_removing_loose_refs(repo, monkeypatch):
+    oid = _commit_shadowed_branch()
+    _check_packed_first(monkeypatch, "refs/heads/other", oid)
+    transaction = data.RefTransaction()
+    transaction.update("refs/heads/other", data.RefValue(symbolic=False, value=oid))
+    transaction.commit()
+    assert not os.path.exists(f"{data.GIT_DIR}/refs/heads/other")
+
+
+def test_delete_ref_never_falls_back_to_the_packed_value(repo, monkeypatch):
+    _commit_shadowed_branch()
+    _check_packed_first(monkeypatch, "refs/heads/other", None)
+    data.delete_ref("refs/heads/other")
+    assert data.get_ref("refs/heads/other").value is None
@@ -0,0 +1,47 @@
+import hashlib
+import os
+
+from ugit import base, data, remote
+
+
+def _snapshot(directory: str) -> dict:
+    """
+    {path: sha1 of the content} of every file beneath directory.
+    """
+    result = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                result[os.path.relpath(path, directory)] = hashlib.sha1(f.read()).hexdigest()
+    return result
+
+
+def _commit(message: str) -> str:
+    with open("file", "a") as f:
+        f.write(f"{message}\n")
+    return base.commit(message)
+
+
+def test_fetch_leaves_the_remote_untouched(repo):
+    os.mkdir("remote")
+    os.chdir("remote")
+    base.init()
+    _commit("first")
+    os.chdir("..")
+
+    os.mkdir("local")
+    os.chdir("local")
+    base.init()
+    assert remote.fetch("../remote") == {"main": data.get_ref("refs/remote/main").value}
+
+    os.chdir("../remote")
+    _commit("second")
+    _commit("third")
+    # Without a commit-graph, as written by older versions, the walk has to build one
+    os.remove(f"{data.GIT_DIR}/commit-graph")
+    before = _snapshot(".ugit")
+    os.chdir("../local")
+    branches = remote.fetch("../remote")
+    assert _snapshot("../remote/.ugit") == before
+    assert data.object_exists(branches["main"])
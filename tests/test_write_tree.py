@@ -0,0 +1,73 @@
+import os
+import random
+
+from ugit import base, data
+
+
+def _rebuilt_tree() -> str:
+    """
+    Tree of the workspace written from an empty index, so without any cached tree.
+    """
+    os.rename(f"{data.GIT_DIR}/index", f"{data.GIT_DIR}/index.saved")
+    try:
+        return base.write_tree()
+    finally:
+        os.replace(f"{data.GIT_DIR}/index.saved", f"{data.GIT_DIR}/index")
+
+
+def test_cached_trees_follow_empty_directories(repo):
+    os.makedirs("d/e")
+    with open("d/e/f", "w") as f:
+        f.write("f\n")
+    base.commit("initial")
+
+    os.mkdir("empty")
+    assert base.write_tree() == _rebuilt_tree()
+    os.rename("empty", "renamed")
+    assert base.write_tree() == _rebuilt_tree()
+    os.rmdir("renamed")
+    assert base.write_tree() == _rebuilt_tree()
+
+
+def test_cached_trees_match_a_rebuilt_index(repo):
+    rng = random.Random(0)
+    directories = ["a", "a/b", "a/b/c", "d", "d/e"]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/file", "w") as f:
+            f.write(directory)
+    base.write_tree()
+
+    for _ in range(100):
+        parent = rng.choice(directories)
+        path = f"{parent}/x{rng.randrange(3)}"
+        if os.path.isdir(path):
+            os.rmdir(path)
+        else:
+            os.mkdir(path)
+        assert base.write_tree() == _rebuilt_tree()
+
+
+def _object_files() -> set:
+    return {
+        os.path.join(root, filename)
+        for root, _, filenames in os.walk(f"{data.GIT_DIR}/objects")
+        for filename in filenames
+    }
+
+
+def test_hashing_a_snapshot_writes_no_object(repo):
+    os.mkdir("d")
+    for path in ("d/f", "d/g", "h"):
+        with open(path, "w") as f:
+            f.write(f"{path}\n")
+    commit = base.commit("initial")
+    objects = _object_files()
+
+    for content in ("changed\n", "changed again\n"):
+        with open("d/g", "w") as f:
+            f.write(content)
+        tree = base.write_tree(save_blobs=False)
+        changes = list(base.iter_tree_changes(base.get_commit(commit).tree, tree))
+        assert [path for path, _, _ in changes] == ["d/g"]
+        assert _object_files() == objects
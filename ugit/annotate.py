@@ -0,0 +1,162 @@
+"""Find the commit that introduced each line of a file.
+
+The history is walked from the newest commit by decreasing generation, so a
+commit is handled after all of its children. Every commit holds the lines it
+is suspected of introducing. A parent with the same blob at the path takes
+them all without reading anything; otherwise the parent's version is diffed
+in-process and it takes the lines it already had. What no parent takes was
+introduced by the commit. Each version of the file is read and split once.
+"""
+import heapq
+
+from collections import namedtuple
+from typing import Dict, List
+
+from . import base, commit_graph, data, diff, trace
+
+# Commit that introduced a line and the line's index in that commit's version
+Origin = namedtuple("Origin", ["commit", "line"])
+# Memory budget of annotated files, unless set by 'core.annotateCacheSize'
+DEFAULT_CACHE_SIZE = 16 << 20
+
+_cache: data.LRUCache = None
+
+
+def get_cache() -> data.LRUCache:
+    """
+    Process-wide cache of annotations keyed by (blob oid, path, commit oid),
+    the commit being the one that introduced this version of the file. The
+    origins of a blob's lines depend on the history behind that commit, so
+    the blob alone is not enough of a key, but every later commit with the
+    same version shares the annotation.
+    """
+    global _cache
+    if _cache is None:
+        max_bytes = int(data.get_config("core.annotateCacheSize", DEFAULT_CACHE_SIZE))
+        _cache = data.LRUCache(max_bytes, lambda origins: 64 + 120 * len(origins))
+        cache = _cache
+        trace.gauge("annotate cache hits", lambda: cache.hits)
+        trace.gauge("annotate cache misses", lambda: cache.misses)
+    return _cache
+
+
+class _Suspect:
+    """
+    Lines of the final file that a commit is suspected of introducing, by
+    their index in the commit's version of the file.
+    """
+
+    def __init__(self, blob: str):
+        self.blob = blob
+        # index in this version -> indexes in the final file
+        self.lines: Dict[int, List[int]] = {}
+
+    def add(self, line: int, finals: List[int]):
+        self.lines.setdefault(line, []).extend(finals)
+
+
+def _version_commit(graph: commit_graph.CommitGraph, commit: str, path: str, blob: str) -> str:
+    """
+    Return the commit that introduced blob at path, going down from commit for
+    as long as the first parent having path has the same blob: the walk below
+    hands all the lines down to such a parent.
+    """
+    while True:
+        for parent in graph.get(commit).parents:
+            parent_blob = base.get_path_oid(graph.get(parent).tree, path)
+            if parent_blob is not None:
+                break
+        else:
+            return commit
+        if parent_blob != blob:
+            return commit
+        commit = parent
+
+
+@trace.timed()
+def annotate(commit: str, path: str) -> List[Origin]:
+    """
+    Return the Origin of every line of path in commit.
+    """
+    blob = base.get_path_oid(base.get_commit(commit).tree, path)
+    assert blob is not None, f"{path} does not exist in {commit}"
+
+    commit_graph.add_commits([commit])
+    graph = commit_graph.get_graph()
+    commit = _version_commit(graph, commit, path, blob)
+    cache = get_cache()
+    key = (blob, path, commit)
+    origins = cache.get(key)
+    if origins is not None:
+        return origins
+
+    file_lines: Dict[str, List[bytes]] = {}
+
+    def read_lines(oid: str) -> List[bytes]:
+        lines = file_lines.get(oid)
+        if lines is None:
+            lines = file_lines[oid] = diff.split_lines(data.get_object(oid, "blob"))
+        return lines
+
+    origins: List[Origin] = [None] * len(read_lines(blob))
+    root = _Suspect(blob)
+    for i in range(len(origins)):
+        root.add(i, [i])
+    suspects = {commit: root}
+    queue = [(-graph.get(commit).generation, commit)]
+
+    while queue:
+        _, oid = heapq.heappop(queue)
+        suspect = suspects.pop(oid)
+
+        cached = cache.get((suspect.blob, path, oid))
+        if cached is not None:
+            for line, finals in suspect.lines.items():
+                for final in finals:
+                    origins[final] = cached[line]
+            continue
+
+        lines = suspect.lines
+        for parent in graph.get(oid).parents:
+            if not lines:
+                break
+            parent_blob = base.get_path_oid(graph.get(parent).tree, path)
+            if parent_blob is None:
+                continue
+            if parent not in suspects:
+                suspects[parent] = _Suspect(parent_blob)
+                heapq.heappush(queue, (-graph.get(parent).generation, parent))
+            parent_suspect = suspects[parent]
+
+            if parent_blob == suspect.blob:
+                # Unchanged in this parent, which is suspected of everything
+                for line, finals in lines.items():
+                    parent_suspect.add(line, finals)
+                lines = {}
+                break
+
+            # Lines kept from the parent move there, the rest stay suspected here
+            remaining = {}
+            to_parent = {}
+            ops = diff.diff_lines(read_lines(parent_blob), read_lines(suspect.blob))
+            for tag, parent_line, line, _ in ops:
+                if tag == b" ":
+                    to_parent[line] = parent_line
+            for line, finals in lines.items():
+                if line in to_parent:
+                    parent_suspect.add(to_parent[line], finals)
+                else:
+                    remaining[line] = finals
+            lines = remaining
+
+        for line, finals in lines.items():
+            for final in finals:
+                origins[final] = Origin(oid, line)
+
+        # Drop the versions that no pending commit needs anymore
+        needed = {pending.blob for pending in suspects.values()}
+        for old in set(file_lines) - needed:
+            del file_lines[old]
+
+    cache.put(key, origins)
+    return origins
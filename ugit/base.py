@@ -1,16 +1,23 @@
 """A higher level module on top of data.
 """
+import heapq
 import os
 import itertools
 import operator
+import stat
 import string
 
 from collections import namedtuple, deque
-from typing import Iterable, Dict, AnyStr
-from . import data, diff
+from typing import Iterable, Dict, List, Set, Tuple
+from . import data, diff, index, ignore, commit_graph, fsmonitor, sparse, trace
 
 S = os.sep
 Commit = namedtuple("Commit", ["tree", "parents", "message"])
+TreeEntry = namedtuple("TreeEntry", ["type_", "oid", "name"])
+# Number of worker threads, overrides the 'core.jobs' config when set
+JOBS = None
+# Memory budget of parsed commits and trees, unless set by 'core.objectCacheSize'
+DEFAULT_OBJECT_CACHE_SIZE = 64 << 20
 
 
 def init():
@@ -19,93 +26,552 @@ def init():
     data.update_ref("HEAD", data.RefValue(symbolic=True, value="refs/heads/main"))
 
 
-def write_tree(directory="."):
+@trace.timed()
+def write_tree(directory=".", save_blobs: bool = True):
     """
     Save a version of the directory in ugit object database,
     without addtional context.
+    With save_blobs False, nothing is saved: the trees are only hashed, and
+    kept in memory until the next such call so the snapshot can be compared
+    with other trees.
+    In a sparse checkout, the top directory takes everything outside the
+    sparse checkout from HEAD.
     """
-    entries = []
+    directory = os.path.relpath(directory)
+    cone = sparse.get_cone() if directory == "." else None
+    excluded = _get_excluded_entries(cone) if cone else {}
+    with index.get_index() as idx:
+        rules = ignore.Ignore()
+        cached = {}
+        changed = _query_fsmonitor(idx) if directory == "." else None
+        if changed is None:
+            root = _scan_directory(directory, rules, cone)
+            paths = list(_iter_node_files(root))
+            oids = dict(zip(paths, _hash_workspace_files(idx, paths, write=False)))
+            if directory == ".":
+                idx.retain(paths)
+
+            # A directory whose files are all unchanged according to the index
+            # reuses its cached tree oid, only directories along changed paths are rehashed.
+            _find_cached_trees(idx, root, cached, cone)
+        else:
+            oids = {}
+            root = _scan_changed(idx, changed, rules, oids, cached, cone)
+
+        if not save_blobs:
+            _unsaved_trees.clear()
+            return _write_tree_node(idx, root, oids, cached, excluded, save=False)
+
+        # The index may know blobs that were only hashed, never saved
+        to_save = [
+            path
+            for directory_, files, _ in _iter_nodes(root)
+            if cached[directory_][0] is None
+            for path in files
+        ]
+        chunk_threshold = int(data.get_config("core.chunkThreshold", 0))
+        saved = _parallel_map(
+            lambda path: _save_blob(path, oids[path], chunk_threshold), to_save
+        )
+        oids.update(zip(to_save, saved))
+
+        return _write_tree_node(idx, root, oids, cached, excluded)
+
+
+# A scanned directory: (path, file paths, subdirectory nodes)
+_Node = Tuple[str, List[str], list]
+# Entries of the trees hashed by write_tree without being saved
+_unsaved_trees: Dict[str, Tuple] = {}
+
+
+def _scan_directory(directory: str, rules: ignore.Ignore, cone: sparse.Cone = None) -> _Node:
+    """
+    Scan the workspace beneath directory, only the part in cone when given.
+    """
+    files = []
+    subdirs = []
+    trace.count("directories walked")
     with os.scandir(directory) as it:
         for entry in it:
-            full = f"{directory}/{entry.name}"
-            if is_ignored(full):
+            path = entry.name if directory == "." else f"{directory}/{entry.name}"
+            is_dir = entry.is_dir(follow_symlinks=False)
+            # Ignored directories are never entered
+            if rules.is_ignored(path, is_dir):
                 continue
-            if entry.is_file(follow_symlinks=False):
-                type_ = "blob"
-                with open(full, "rb") as f:
-                    oid = data.hash_object(f.read())
-            elif entry.is_dir(follow_symlinks=False):
-                type_ = "tree"
-                write_tree(full)
-                oid = write_tree(full)
-            entries.append((entry.name, oid, type_))
-    tree = "".join(f"{type_} {oid} {name}\n" for name, oid, type_ in sorted(entries))
-    # print(tree)
-    return data.hash_object(tree.encode(), "tree")
-
-
-def _empty_current_directory():
-    for dirpath, dirnames, filenames in os.walk(".", topdown=False):
-        # down to top
-        for filename in filenames:
-            path = os.path.relpath(f"{dirpath}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
+            inside = _in_cone(cone, path, is_dir)
+            if inside is None:
                 continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f"{dirpath}/{dirname}")
-            if is_ignored(path):
+            if is_dir:
+                subdirs.append(_scan_directory(path, rules, None if inside else cone))
+            elif entry.is_file(follow_symlinks=False):
+                files.append(path)
+    return directory, files, subdirs
+
+
+def _in_cone(cone: sparse.Cone, path: str, is_dir: bool) -> bool:
+    """
+    Return True if path is in cone (or there is no cone), False for a
+    directory leading to it, None for a path to leave out.
+    """
+    if cone is None or cone.contains(path):
+        return True
+    if is_dir and cone.leads_to(path):
+        return False
+    return None
+
+
+def _get_excluded_entries(cone: sparse.Cone) -> Dict[str, List[TreeEntry]]:
+    """
+    Return {directory leading to cone: entries of HEAD's tree there that are
+    outside cone}, which snapshots of the sparse checkout keep unchanged.
+    Only the trees on the way to cone are read.
+    """
+    excluded = {directory: [] for directory in cone.parents}
+    HEAD = data.get_ref("HEAD").value
+    pending = [(".", HEAD and get_commit(HEAD).tree)]
+    while pending:
+        directory, tree = pending.pop()
+        for entry in _iter_tree_entries(tree):
+            path = entry.name if directory == "." else f"{directory}/{entry.name}"
+            if cone.contains(path):
                 continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # Deletion might fail if the directory contians ignored files,
-                # so it's OK to pass
-                pass
+            if entry.type_ == "tree" and cone.leads_to(path):
+                pending.append((path, entry.oid))
+            else:
+                excluded[directory].append(entry)
+    return excluded
+
+
+def _iter_nodes(node: _Node) -> Iterable[_Node]:
+    yield node
+    for subdir in node[2]:
+        yield from _iter_nodes(subdir)
+
+
+def _iter_node_files(node: _Node) -> Iterable[str]:
+    for _, files, _ in _iter_nodes(node):
+        yield from files
+
+
+def _query_fsmonitor(idx: index.Index) -> Set[str]:
+    """
+    Return the paths changed since the index was last brought up to date,
+    according to the filesystem monitor, None if the workspace must be scanned.
+    """
+    token, changed = fsmonitor.query(idx.fsmonitor_token)
+    # Taken before looking at the workspace, so later changes are in the next answer
+    idx.set_fsmonitor_token(token)
+    if changed is None or any(os.path.basename(path) == ignore.IGNORE_FILE for path in changed):
+        # Files may have become ignored or not anywhere beneath an ignore file
+        return None
+    return changed
+
+
+def _scan_changed(
+    idx: index.Index, changed: Set[str], rules: ignore.Ignore, oids: Dict, cached: Dict,
+    cone: sparse.Cone = None
+) -> _Node:
+    """
+    Like _scan_directory on the whole workspace followed by hashing, but only
+    looking at changed paths: directories with a cached tree and no change
+    beneath are not listed, files that did not change take their oid from the
+    index without a stat, and changed directories are scanned entirely.
+    Fill oids and cached as write_tree does.
+    """
+    rescan = set()
+    to_hash = []
+    for path in changed:
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            rescan.add(path)
+        elif (
+            st is not None and stat.S_ISREG(st.st_mode) and not _is_ignored(rules, path)
+            and _in_cone(cone, path, False)
+        ):
+            to_hash.append(path)
+        else:
+            # Removed, or a directory that was removed with its files
+            idx.remove(path)
+            prefix = f"{path}/"
+            for removed in [entry for entry in idx.entries if entry.startswith(prefix)]:
+                idx.remove(removed)
+    oids.update(zip(to_hash, _hash_workspace_files(idx, to_hash, write=False)))
+
+    # Directories with a change beneath
+    dirty = set()
+    for path in changed:
+        while path != ".":
+            path = os.path.dirname(path) or "."
+            if path in dirty:
+                break
+            dirty.add(path)
+    return _scan_changed_directory(".", idx, rules, dirty, rescan, oids, cached, cone)[0]
+
+
+def _is_ignored(rules: ignore.Ignore, path: str) -> bool:
+    rule = rules.check(path, False)
+    return rule is not None and not rule.negate
+
+
+def _scan_changed_directory(
+    directory: str, idx: index.Index, rules: ignore.Ignore, dirty: Set[str], rescan: Set[str],
+    oids: Dict, cached: Dict, cone: sparse.Cone = None
+) -> Tuple[_Node, int]:
+    """
+    Return the node of directory and the number of files beneath it.
+    """
+    if directory in rescan:
+        node = _scan_directory(directory, rules, cone)
+        paths = list(_iter_node_files(node))
+        oids.update(zip(paths, _hash_workspace_files(idx, paths, write=False)))
+        prefix = f"{directory}/"
+        for stale in {entry for entry in idx.entries if entry.startswith(prefix)} - set(paths):
+            idx.remove(stale)
+        return node, _find_cached_trees(idx, node, cached, cone)
+
+    tree = idx.trees.get(directory)
+    if tree is not None and directory not in dirty and not (cone and cone.leads_to(directory)):
+        cached[directory] = (tree.oid, tree.count)
+        return (directory, [], []), tree.count
+
+    files = []
+    subdirs = []
+    count = 0
+    unknown = []
+    trace.count("directories walked")
+    with os.scandir(directory) as it:
+        for entry in it:
+            path = entry.name if directory == "." else f"{directory}/{entry.name}"
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if rules.is_ignored(path, is_dir):
+                continue
+            inside = _in_cone(cone, path, is_dir)
+            if inside is None:
+                continue
+            if is_dir:
+                node, sub_count = _scan_changed_directory(
+                    path, idx, rules, dirty, rescan, oids, cached, None if inside else cone
+                )
+                subdirs.append(node)
+                count += 1 + sub_count
+            elif entry.is_file(follow_symlinks=False):
+                files.append(path)
+                if path not in oids:
+                    known = idx.entries.get(path)
+                    if known is None:
+                        unknown.append(path)
+                    else:
+                        oids[path] = known.oid
+    oids.update(zip(unknown, _hash_workspace_files(idx, unknown, write=False)))
+    count += len(files)
+    node = (directory, files, subdirs)
+    cached[directory] = (_get_cached_tree(idx, node, count, cached, cone), count)
+    return node, count
+
+
+def _find_cached_trees(
+    idx: index.Index, node: _Node, cached: Dict, cone: sparse.Cone = None
+) -> int:
+    """
+    Fill cached with {directory: (cached tree oid or None, entry count)},
+    return the number of files and directories beneath node.
+    """
+    directory, files, subdirs = node
+    count = len(files) + sum(1 + _find_cached_trees(idx, sub, cached, cone) for sub in subdirs)
+    cached[directory] = (_get_cached_tree(idx, node, count, cached, cone), count)
+    return count
+
+
+def _get_cached_tree(
+    idx: index.Index, node: _Node, count: int, cached: Dict, cone: sparse.Cone
+) -> str:
+    directory, _, subdirs = node
+    # A directory leading to the sparse checkout also holds parts of HEAD,
+    # which change without the workspace noticing
+    if cone is not None and cone.leads_to(directory):
+        return None
+    # A subdirectory without a cached tree is new, renamed or changed, even
+    # an empty one that leaves the count as it was
+    if any(cached[subdir[0]][0] is None for subdir in subdirs):
+        return None
+    return idx.get_tree(directory, count)
+
+
+def _save_blob(path: str, oid: str, chunk_threshold: int = 0) -> str:
+    """
+    Save a file as a blob, chunked if it has chunk_threshold bytes or more
+    and chunk_threshold is set.
+    """
+    if data.freshen_object(oid):
+        return oid
+    if chunk_threshold and os.path.getsize(path) >= chunk_threshold:
+        return data.hash_chunked_file(path)
+    return data.hash_file(path)
+
+
+def _write_tree_node(
+    idx: index.Index, node: _Node, oids: Dict, cached: Dict, excluded: Dict,
+    save: bool = True
+) -> str:
+    """
+    Save the tree of node, and cache it in the index. With save False, the
+    tree is only hashed and kept in _unsaved_trees. A directory in excluded, leading to the sparse
+    checkout, also gets the entries of HEAD outside of it; such a tree is
+    None when it would be empty and the directory is not in the workspace.
+    """
+    directory, files, subdirs = node
+    oid, count = cached.get(directory, (None, 0))
+    if oid is not None:
+        return oid
+
+    entries = [(os.path.basename(path), oids[path], "blob") for path in files]
+    for subdir in subdirs:
+        entries.append(
+            (
+                os.path.basename(subdir[0]),
+                _write_tree_node(idx, subdir, oids, cached, excluded, save),
+                "tree",
+            )
+        )
+    if directory in excluded:
+        # A directory of the workspace replaces a file of HEAD with the same name
+        scanned = {subdir[0] for subdir in subdirs}
+        entries += [
+            (entry.name, entry.oid, entry.type_)
+            for entry in excluded[directory]
+            if (entry.name if directory == "." else f"{directory}/{entry.name}") not in scanned
+        ]
+        # Directories leading to the cone whose files all left the workspace
+        for path in excluded:
+            if path != "." and (os.path.dirname(path) or ".") == directory and path not in scanned:
+                oid = _write_tree_node(idx, (path, [], []), oids, cached, excluded, save)
+                if oid is not None:
+                    entries.append((os.path.basename(path), oid, "tree"))
+        if not entries and directory not in cached:
+            return None
+    entries.sort()
+    tree = "".join(f"{type_} {oid} {name}\n" for name, oid, type_ in entries)
+    oid = data.hash_object(tree.encode(), "tree", write=save)
+    if not save:
+        # Its blobs may not be saved either, so it must not be cached
+        _unsaved_trees[oid] = tuple(TreeEntry(type_, oid_, name) for name, oid_, type_ in entries)
+    elif directory not in excluded:
+        idx.set_tree(directory, oid, count)
+    return oid
+
+
+def get_jobs() -> int:
+    """
+    Number of worker threads, from the -j option or the 'core.jobs' config.
+    """
+    if JOBS is not None:
+        return JOBS
+    return int(data.get_config("core.jobs", 1))
+
+
+def _parallel_map(func, items: List) -> List:
+    """
+    Like map, but fans out to a thread pool when more than one job is configured.
+    Results keep the order of items, so output is the same as the serial path.
+    """
+    jobs = get_jobs()
+    if jobs <= 1 or len(items) <= 1:
+        return list(map(func, items))
+    # Imported here, it is one of the slowest imports and most runs are serial
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(func, items))
 
 
-def _iter_tree_entries(oid: str):
+def _iter_tree_entries(oid: str) -> Iterable[TreeEntry]:
     """
     Iterate through a level in tree and yield [type, oid, name] line by line.
     """
     if not oid:
         return
-    tree = data.get_object(oid, "tree")
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(" ", 2)
-        yield type_, oid, name
+    cache = get_object_cache()
+    entries = cache.get(oid)
+    if entries is None:
+        entries = _unsaved_trees.get(oid)
+    if entries is None:
+        tree = data.get_object(oid, "tree")
+        entries = tuple(
+            TreeEntry(*entry.split(" ", 2)) for entry in tree.decode().splitlines()
+        )
+        cache.put(oid, entries)
+    yield from entries
 
 
-def get_tree(oid: str, base_path: str = "") -> Dict[str, AnyStr]:
+_object_cache: data.LRUCache = None
+
+
+def get_object_cache() -> data.LRUCache:
     """
-    Extract the whole tree recursively as a Dict.
+    Process-wide cache of parsed commits and trees keyed by oid. Objects are
+    immutable, so entries are only ever evicted to stay in the memory budget.
     """
-    result = {}
-    for type_, oid, name in _iter_tree_entries(oid):
+    global _object_cache
+    if _object_cache is None:
+        max_bytes = int(data.get_config("core.objectCacheSize", DEFAULT_OBJECT_CACHE_SIZE))
+        _object_cache = data.LRUCache(max_bytes, _parsed_object_size)
+        cache = _object_cache
+        trace.gauge("object cache hits", lambda: cache.hits)
+        trace.gauge("object cache misses", lambda: cache.misses)
+    return _object_cache
+
+
+def _parsed_object_size(parsed) -> int:
+    """
+    Rough memory footprint of a parsed commit or tree.
+    """
+    if isinstance(parsed, Commit):
+        return 200 + len(parsed.message) + 90 * len(parsed.parents)
+    return 64 + sum(200 + len(entry.name) for entry in parsed)
+
+
+def iter_tree_changes(
+    *oids: str, base_path: str = "", cone: sparse.Cone = None
+) -> Iterable[Tuple]:
+    """
+    Compare trees level by level, yield (path, *blob oids) for every path that
+    differs between them, None where a tree has no blob at path.
+    Subtrees with the same oid everywhere are skipped without being read, and
+    so are the ones outside cone when given.
+    """
+    levels = [
+        {name: (type_, oid) for type_, oid, name in _iter_tree_entries(oid)}
+        for oid in oids
+    ]
+    for name in sorted(set().union(*levels)):
+        entries = [level.get(name) for level in levels]
+        if entries.count(entries[0]) == len(entries):
+            continue
         assert "/" not in name
         assert name not in ("..", ".")
+        for entry in entries:
+            assert entry is None or entry[0] in ("blob", "tree"), f"Unknown tree entry {entry[0]}"
         path = base_path + name
-        if type_ == "blob":
-            result[path] = oid
-        elif type_ == "tree":
-            result.update(get_tree(oid, f"{path}/"))
-        else:
-            assert False, f"Unknown tree entry {type_}"
-    return result
+        blobs = [entry[1] if entry and entry[0] == "blob" else None for entry in entries]
+        trees = [entry[1] if entry and entry[0] == "tree" else None for entry in entries]
+        inside = cone is None or cone.contains(path)
+        # A path can be a file in one tree and a directory in another
+        if blobs.count(blobs[0]) != len(blobs) and inside:
+            yield (path, *blobs)
+        if trees.count(trees[0]) != len(trees) and (inside or cone.leads_to(path)):
+            yield from iter_tree_changes(
+                *trees, base_path=f"{path}/", cone=None if inside else cone
+            )
+
+
+@trace.timed()
+def read_tree(tree_oid: str, base_tree: str = None):
+    """
+    Move the workspace from the snapshot base_tree (HEAD's tree by default)
+    to tree_oid. Only files that differ between the two snapshots are written
+    or deleted, untracked files and local changes to other files are kept.
+    """
+    if base_tree is None:
+        HEAD = data.get_ref("HEAD").value
+        base_tree = HEAD and get_commit(HEAD).tree
 
+    _update_workspace(iter_tree_changes(base_tree, tree_oid, cone=sparse.get_cone()))
 
-def read_tree(tree_oid: str):
+
+@trace.timed()
+def set_sparse_checkout(prefixes: List[str]):
+    """
+    Change the directories of the sparse checkout, none checks out everything.
+    Files of HEAD leaving the checkout are removed from the workspace, the
+    ones entering it are written.
+    """
+    old = sparse.get_cone()
+    sparse.set_prefixes(prefixes)
+    new = sparse.get_cone()
+    HEAD = data.get_ref("HEAD").value
+    tree = HEAD and get_commit(HEAD).tree
+
+    changes = []
+    if old is not None:
+        changes += [
+            (path, None, oid)
+            for path, _, oid in iter_tree_changes(None, tree, cone=new)
+            if not old.contains(path)
+        ]
+    if new is not None:
+        changes += [
+            (path, oid, None)
+            for path, _, oid in iter_tree_changes(None, tree, cone=old)
+            if not new.contains(path)
+        ]
+    _update_workspace(changes)
+
+
+@trace.timed()
+def _update_workspace(changes: Iterable[Tuple[str, str, str]]):
+    """
+    Apply (path, base oid, target oid) changes to the workspace.
     """
-    Empty current workspace, and restore a previous workspace
-    from tree object.
+    removed = []
+    changed = []
+    for path, o_base, o_target in changes:
+        if o_target is None:
+            removed.append(path)
+        elif o_base != o_target:
+            changed.append((path, o_target))
+
+    # A directory replaced by a file may only hold files that are deleted,
+    # untracked files are never lost
+    to_remove = set(removed)
+    for path, _ in changed:
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                kept = os.path.join(root, filename).replace(S, "/")
+                assert kept in to_remove, f"Cannot replace directory {path}, {kept} is untracked"
+
+    with index.get_index() as idx:
+        # Deletions come first, a deleted file may be replaced by a directory
+        for path in removed:
+            _remove_workspace_file(path)
+            idx.remove(path)
+        for path, _ in changed:
+            # Only empty directories are left
+            for root, _, _ in os.walk(path, topdown=False):
+                os.rmdir(root)
+        for directory in {os.path.dirname(path) for path, _ in changed}:
+            os.makedirs(f"./{directory}", exist_ok=True)
+        stats = _parallel_map(_write_workspace_file, changed)
+        for (path, oid), st in zip(changed, stats):
+            # Remember what was just written, so the next status needs no rehash
+            idx.update(path, st, oid)
+
+
+def _remove_workspace_file(path: str):
     """
-    _empty_current_directory()
-    for path, oid in get_tree(tree_oid, base_path="./").items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(data.get_object(oid))
+    Remove a file, and its parent directories that become empty.
+    """
+    if os.path.isfile(path):
+        os.remove(path)
+    try:
+        os.removedirs(os.path.dirname(path))
+    except OSError:
+        # Reached a non-empty directory, or path is at the top level
+        pass
+
 
+@trace.timed()
+def _write_workspace_file(item: Tuple[str, str]) -> os.stat_result:
+    path, oid = item
+    with open(path, "wb") as f:
+        for chunk in data.iter_object(oid):
+            f.write(chunk)
+    return os.lstat(path)
 
+
+@trace.timed()
 def commit(message: str):
     """
     Copy current directory to object database with author and time,
@@ -123,6 +589,7 @@ def commit(message: str):
     commit += f"{message}\n"
 
     oid = data.hash_object(commit.encode(), "commit")
+    commit_graph.add_commits([oid])
     data.update_ref("HEAD", value=data.RefValue(symbolic=False, value=oid), deref=True)
 
     return oid
@@ -132,6 +599,11 @@ def get_commit(oid: str) -> Commit:
     """
     Get commit(tree, parents, message) from object database.
     """
+    cache = get_object_cache()
+    cached = cache.get(oid)
+    if cached is not None:
+        return cached
+
     parents = []
     commit = data.get_object(oid, "commit").decode()
     lines = iter(commit.splitlines())
@@ -146,7 +618,9 @@ def get_commit(oid: str) -> Commit:
             assert False, f"Unknown field {key}"
 
     message = "\n".join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+    commit = Commit(tree=tree, parents=parents, message=message)
+    cache.put(oid, commit)
+    return commit
 
 
 def checkout(name: str):
@@ -181,9 +655,10 @@ def get_oid(name: str) -> str:
         f"refs/heads/{name}",
     ]
     for ref in refs_to_try:
-        if data.get_ref(ref, deref=False).value:
+        value = data.get_ref(ref, deref=False)
+        if value.value:
             # if reference has value, return the ultimate value
-            return data.get_ref(ref).value
+            return data.get_ref(value.value).value if value.symbolic else value.value
 
     # Name is SHA1
     is_hex = all(c in string.hexdigits for c in name)
@@ -193,12 +668,16 @@ def get_oid(name: str) -> str:
     assert False, f"Unknown name {name}"
 
 
-def iter_commits_and_parents(oids) -> Iterable[str]:
+def iter_commits_and_parents(
+    oids, exclude: Iterable[str] = (), update_graph: bool = True
+) -> Iterable[str]:
     """
     Iterate through the commit history from now to past.
+    Commits reachable from exclude are left out, and their history is not walked.
+    With update_graph False, the commit-graph file is not written.
     """
     oids = deque(oids)
-    visited = set()
+    visited = _hidden_commits(oids, exclude, update_graph) if exclude else set()
 
     while oids:
         oid = oids.popleft()
@@ -207,9 +686,97 @@ def iter_commits_and_parents(oids) -> Iterable[str]:
         visited.add(oid)
         yield oid
 
-        commit = get_commit(oid)
-        oids.extendleft(commit.parents[:1])
-        oids.extend(commit.parents[1:])
+        parents = get_parents(oid)
+        oids.extendleft(parents[:1])
+        oids.extend(parents[1:])
+
+
+def get_parents(oid: str) -> List[str]:
+    """
+    Parents of a commit, from the commit-graph if it has the commit.
+    """
+    graph_commit = commit_graph.get_commit(oid)
+    if graph_commit is not None:
+        return graph_commit.parents
+    return get_commit(oid).parents
+
+
+@trace.timed()
+def _hidden_commits(
+    oids: Iterable[str], exclude: Iterable[str], update_graph: bool = True
+) -> set:
+    """
+    Return the commits reachable from exclude that a walk from oids can reach
+    without going through another such commit, enough to cut the walk there.
+    """
+    oids = [oid for oid in oids if oid]
+    exclude = [oid for oid in exclude if oid]
+    graph = commit_graph.get_graph_of([*oids, *exclude], update=update_graph)
+
+    # Same walk as get_merge_base: by decreasing generation, a commit has all
+    # its flags when popped. It stops once every queued commit is hidden, the
+    # older history is then hidden as well and never visited.
+    SHOWN, HIDDEN = 1, 2
+    flags = {oid: SHOWN for oid in oids}
+    flags.update((oid, HIDDEN) for oid in exclude)
+    queue = [(-graph.get(oid).generation, oid) for oid in flags]
+    heapq.heapify(queue)
+    shown = {oid for oid, flag in flags.items() if flag == SHOWN}
+    done = set()
+    while shown:
+        _, oid = heapq.heappop(queue)
+        if oid in done:
+            continue
+        done.add(oid)
+        shown.discard(oid)
+        for parent in graph.get(oid).parents:
+            parent_flags = flags.get(parent, 0)
+            if parent_flags | flags[oid] != parent_flags:
+                flags[parent] = parent_flags | flags[oid]
+                heapq.heappush(queue, (-graph.get(parent).generation, parent))
+            if flags[parent] & HIDDEN:
+                shown.discard(parent)
+            elif parent not in done:
+                shown.add(parent)
+    return {oid for oid, flag in flags.items() if flag & HIDDEN}
+
+
+def get_path_oid(tree_oid: str, path: str) -> str:
+    """
+    Return the oid of the blob or tree at path in a tree, None if there is none.
+    Only the trees on the way to path are read.
+    """
+    oid = tree_oid
+    for name in path.split("/"):
+        oid = next((entry.oid for entry in _iter_tree_entries(oid) if entry.name == name), None)
+        if oid is None:
+            break
+    return oid
+
+
+def iter_path_commits(oids: Iterable[str], paths: List[str]) -> Iterable[str]:
+    """
+    Filter the commits of a history to those that changed any of paths: the
+    object at a path differs from the one in every parent, so a merge is only
+    kept when it changed the path against both sides. Paths are compared by
+    the oids of their blobs or subtrees, whole trees are never flattened.
+    """
+    for oid in oids:
+        graph_commit = commit_graph.get_commit(oid)
+        commit = graph_commit or get_commit(oid)
+        path_oids = [get_path_oid(commit.tree, path) for path in paths]
+        parents = [
+            commit_graph.get_commit(parent) or get_commit(parent) for parent in commit.parents
+        ]
+        if not parents:
+            changed = any(path_oids)
+        else:
+            changed = all(
+                [get_path_oid(parent.tree, path) for path in paths] != path_oids
+                for parent in parents
+            )
+        if changed:
+            yield oid
 
 
 def create_branch(name: str, oid: str):
@@ -239,18 +806,23 @@ def reset(oid: str):
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=oid))
 
 
-def get_working_tree():
-    result = {}
-    for root, _, filenames in os.walk("."):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
-    return result
+@trace.timed()
+def _hash_workspace_files(idx: index.Index, paths: List[str], write: bool = True) -> List[str]:
+    """
+    Return the oids of workspace files, taking them from the index if the files
+    are unchanged since they were last hashed, the others are hashed in parallel.
+    """
+    stats = [os.lstat(path) for path in paths]
+    oids = [idx.lookup(path, st) for path, st in zip(paths, stats)]
+    misses = [i for i, oid in enumerate(oids) if oid is None]
+    hashed = _parallel_map(lambda i: data.hash_file(paths[i], write=write), misses)
+    for i, oid in zip(misses, hashed):
+        oids[i] = oid
+        idx.update(paths[i], stats[i], oid)
+    return oids
 
 
+@trace.timed()
 def merge(other: str):
     """
     Merge other branch to HEAD (current branch)
@@ -267,36 +839,61 @@ def merge(other: str):
         print('Fast-forward merge, no need to commit')
         return
 
-    data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
-
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_HEAD.tree, c_other.tree, c_base.tree)
-    print("Merged in working tree\nPlease commit")
+    conflicts = read_tree_merged(c_HEAD.tree, c_other.tree, c_base.tree)
+    data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
+    print("Merged in working tree")
+    for path, oid in conflicts:
+        print(f"CONFLICT (binary): kept HEAD's version of {path}, MERGE_HEAD's is blob {oid}")
+    print("Please commit")
 
 
-def read_tree_merged(o_HEAD, o_other, o_base):
-    _empty_current_directory()
-    for path, blob in diff.merge_trees(
-        get_tree(o_HEAD), get_tree(o_other), get_tree(o_base)
-    ).items():
-        os.makedirs(f"./{os.path.dirname(path)}", exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(blob)
+def read_tree_merged(o_HEAD, o_other, o_base) -> List[Tuple[str, str]]:
+    """
+    Merge the trees into the workspace, which is expected to match o_HEAD.
+    In a sparse checkout, the merge must only change files inside of it.
+    Return (path, other oid) of the binary files that could not be merged.
+    """
+    conflicts = []
+    changes = list(diff.merge_trees(iter_tree_changes(o_HEAD, o_other, o_base), conflicts))
+    cone = sparse.get_cone()
+    paths = [path for path, _, _ in changes] + [path for path, _ in conflicts]
+    outside = [path for path in paths if cone is not None and not cone.contains(path)]
+    assert not outside, f"Merge changes files outside the sparse checkout: {', '.join(outside)}"
+    _update_workspace(changes)
+    return conflicts
 
 
+@trace.timed()
 def get_merge_base(oid1: str, oid2: str) -> str:
     """
     Return the common ancester OID of two commits, None if no common ancestor.
     """
-    parents1 = set(iter_commits_and_parents({oid1}))
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    if oid1 == oid2:
+        return oid1
+    commit_graph.add_commits([oid1, oid2])
+    graph = commit_graph.get_graph()
+
+    # Walk both histories by decreasing generation, marking which side reaches
+    # each commit. Every child has a larger generation than its parents, so a
+    # commit is complete when popped, and the first one reached from both sides
+    # is a best common ancestor; older history is never visited.
+    flags = {oid1: 1, oid2: 2}
+    queue = [(-graph.get(oid).generation, oid) for oid in {oid1, oid2}]
+    heapq.heapify(queue)
+    done = set()
+    while queue:
+        _, oid = heapq.heappop(queue)
+        if oid in done:
+            continue
+        done.add(oid)
+        if flags[oid] == 3:
             return oid
-
-
-def is_ignored(path) -> bool:
-    # TODO use '.ugitignore' file
-    return ".ugit" in path.split(S) or ".git" in path.split(S) \
-        or ".ugit" in path.split("/") or ".git" in path.split("/")
-    
+        graph_commit = graph.get(oid)
+        for parent in graph_commit.parents:
+            parent_flags = flags.get(parent, 0)
+            if parent_flags | flags[oid] != parent_flags:
+                flags[parent] = parent_flags | flags[oid]
+                heapq.heappush(queue, (-graph.get(parent).generation, parent))
+    return None
@@ -1,163 +1,502 @@
+"""Command line interface.
+
+Only the parser of the invoked command is built, and each command imports
+the modules it needs when it runs, so a trivial command does not pay for
+loading the whole package.
+"""
 import argparse
 import os
 import sys
-import textwrap
-import subprocess
 
-from . import data, base, diff
+from . import trace
 from typing import Dict, Iterable
 
+_HEX_DIGITS = frozenset("0123456789abcdef")
+
 
 def main():
     args = parse_args()
-    args.func(args)
-
-
-def parse_args():
+    if args.jobs:
+        from . import base
+
+        base.JOBS = args.jobs
+    try:
+        with trace.span(f"cli.{args.command}"):
+            args.func(args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away, as in 'ugit log | head'. Point stdout at
+        # devnull so flushing it at exit does not fail again.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="number of worker threads for hashing and checkout"
+    )
     commands = parser.add_subparsers(dest="command")
     commands.required = True
 
-    oid = base.get_oid
+    name = _find_command(argv)
+    if name in COMMANDS:
+        command = commands.add_parser(name)
+        COMMANDS[name](command)
+        if "--" in argv and command.get_default("paths") is not None:
+            # argparse drops '--', the paths after it are taken apart so that
+            # they are never read as a revision
+            i = argv.index("--")
+            args = parser.parse_args(argv[:i])
+            args.paths = argv[i + 1:]
+            return args
+    else:
+        # Help or a typo, list every command without building their arguments
+        for name in COMMANDS:
+            commands.add_parser(name)
+    return parser.parse_args(argv)
+
+
+def _find_command(argv) -> str:
+    """
+    Return the first argument that is not a global option, None if there is none.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg in ("-j", "--jobs"):
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+def oid(name: str) -> str:
+    """
+    Argument type resolving a name to an oid.
+    """
+    from . import base
+
+    return base.get_oid(name)
+
+
+def non_negative(value: str) -> int:
+    """
+    Argument type of a count, 0 or more.
+    """
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return n
+
+
+def _add_init(parser):
+    parser.set_defaults(func=init)
+
+
+def _add_hash_object(parser):
+    parser.set_defaults(func=hash_object)
+    parser.add_argument("file")
+
+
+def _add_cat_file(parser):
+    parser.set_defaults(func=cat_file)
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("object", nargs="?", type=oid)
+    mode.add_argument(
+        "--batch", action="store_true", help="print type, size and content of each object read from stdin"
+    )
+    mode.add_argument(
+        "--batch-check", action="store_true", help="print type and size of each object read from stdin"
+    )
+    parser.add_argument(
+        "--buffer", action="store_true", help="do not flush the output after each object"
+    )
+
+
+def _add_write_tree(parser):
+    parser.set_defaults(func=write_tree)
+
+
+def _add_read_tree(parser):
+    parser.set_defaults(func=read_tree)
+    parser.add_argument("tree", type=oid)
+
+
+def _add_commit(parser):
+    parser.set_defaults(func=commit)
+    parser.add_argument("-m", "--message", required=True)
+
+
+def _add_log(parser):
+    # Paths given after '--', see parse_args
+    parser.set_defaults(func=log, paths=[])
+    parser.add_argument(
+        "-n", "--max-count", type=non_negative, help="show at most this many commits"
+    )
+    parser.add_argument(
+        "args",
+        nargs="*",
+        metavar="revision | path",
+        help="a commit or a range A..B, the commits of B not reachable from A, "
+        "followed by paths that the commits must change. Paths that are not in "
+        "the workspace go after '--'",
+    )
+
+
+def _add_annotate(parser):
+    parser.set_defaults(func=_annotate)
+    parser.add_argument("path")
+    parser.add_argument("commit", default="@", type=oid, nargs="?")
+
+
+def _add_checkout(parser):
+    parser.set_defaults(func=checkout)
+    parser.add_argument("commit")
 
-    init_parser = commands.add_parser("init")
-    init_parser.set_defaults(func=init)
 
-    hash_object_parser = commands.add_parser("hash-object")
-    hash_object_parser.set_defaults(func=hash_object)
-    hash_object_parser.add_argument("file")
+def _add_tag(parser):
+    parser.set_defaults(func=tag)
+    parser.add_argument("name")
+    parser.add_argument("oid", nargs="?", type=oid, default="@")
 
-    cat_file_parser = commands.add_parser("cat-file")
-    cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument("object", type=oid)
 
-    write_tree_parser = commands.add_parser("write-tree")
-    write_tree_parser.set_defaults(func=write_tree)
+def _add_k(parser):
+    parser.set_defaults(func=k)
 
-    read_tree_parser = commands.add_parser("read-tree")
-    read_tree_parser.set_defaults(func=read_tree)
-    read_tree_parser.add_argument("tree", type=oid)
 
-    commit_parser = commands.add_parser("commit")
-    commit_parser.set_defaults(func=commit)
-    commit_parser.add_argument("-m", "--message", required=True)
+def _add_branch(parser):
+    parser.set_defaults(func=branch)
+    parser.add_argument("name", nargs="?")
+    parser.add_argument("start_point", default="@", type=oid, nargs="?")
 
-    log_parser = commands.add_parser("log")
-    log_parser.set_defaults(func=log)
-    log_parser.add_argument("oid", nargs="?", type=oid, default="@")
 
-    checkout_parser = commands.add_parser("checkout")
-    checkout_parser.set_defaults(func=checkout)
-    checkout_parser.add_argument("commit")
+def _add_status(parser):
+    parser.set_defaults(func=status)
 
-    tag_parser = commands.add_parser("tag")
-    tag_parser.set_defaults(func=tag)
-    tag_parser.add_argument("name")
-    tag_parser.add_argument("oid", nargs="?", type=oid, default="@")
 
-    k_parser = commands.add_parser("k")
-    k_parser.set_defaults(func=k)
+def _add_reset(parser):
+    parser.set_defaults(func=reset)
+    parser.add_argument("commit", type=oid)
 
-    branch_parser = commands.add_parser("branch")
-    branch_parser.set_defaults(func=branch)
-    branch_parser.add_argument("name", nargs="?")
-    branch_parser.add_argument("start_point", default="@", type=oid, nargs="?")
 
-    status_parser = commands.add_parser("status")
-    status_parser.set_defaults(func=status)
+def _add_show(parser):
+    parser.set_defaults(func=show)
+    parser.add_argument("oid", default="@", type=oid, nargs="?")
 
-    reset_parser = commands.add_parser("reset")
-    reset_parser.set_defaults(func=reset)
-    reset_parser.add_argument("commit", type=oid)
 
-    show_parser = commands.add_parser("show")
-    show_parser.set_defaults(func=show)
-    show_parser.add_argument("oid", default="@", type=oid, nargs="?")
+def _add_diff(parser):
+    parser.set_defaults(func=_diff)
+    parser.add_argument("commit", default="@", type=oid, nargs="?")
 
-    diff_parser = commands.add_parser("diff")
-    diff_parser.set_defaults(func=_diff)
-    diff_parser.add_argument("commit", default="@", type=oid, nargs="?")
 
-    merge_parser = commands.add_parser("merge")
-    merge_parser.set_defaults(func=merge)
-    merge_parser.add_argument("commit", type=oid)
+def _add_merge(parser):
+    parser.set_defaults(func=merge)
+    parser.add_argument("commit", type=oid)
 
-    merge_base_parser = commands.add_parser('merge-base')
-    merge_base_parser.set_defaults(func=merge_base)
-    merge_base_parser.add_argument('commit1', type=oid)
-    merge_base_parser.add_argument('commit2', type=oid)
 
-    return parser.parse_args()
+def _add_merge_base(parser):
+    parser.set_defaults(func=merge_base)
+    parser.add_argument("commit1", type=oid)
+    parser.add_argument("commit2", type=oid)
+
+
+def _add_fetch(parser):
+    parser.set_defaults(func=fetch)
+    parser.add_argument("remote")
+
+
+def _add_push(parser):
+    parser.set_defaults(func=push)
+    parser.add_argument("remote")
+    parser.add_argument("branch")
+
+
+def _add_fsmonitor(parser):
+    parser.set_defaults(func=_fsmonitor)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--poll", action="store_true", help="scan for changes instead of using inotify")
+    mode.add_argument("--stop", action="store_true", help="stop the running daemon")
+    parser.add_argument(
+        "--interval", type=float, help="seconds between two scans when polling"
+    )
+
+
+def _add_sparse_checkout(parser):
+    parser.set_defaults(func=sparse_checkout)
+    parser.add_argument("directories", nargs="*", help="directories to check out")
+    parser.add_argument("--disable", action="store_true", help="check out everything")
+
+
+def _add_migrate_objects(parser):
+    parser.set_defaults(func=migrate_objects)
+
+
+def _add_config(parser):
+    parser.set_defaults(func=config)
+    parser.add_argument("name")
+    parser.add_argument("value", nargs="?")
+
+
+def _add_commit_graph(parser):
+    parser.set_defaults(func=write_commit_graph)
+
+
+def _add_pack_refs(parser):
+    parser.set_defaults(func=pack_refs)
+
+
+def _add_repack(parser):
+    parser.set_defaults(func=repack)
+
+
+def _add_gc(parser):
+    parser.set_defaults(func=_gc)
+    parser.add_argument(
+        "--grace", type=int, help="seconds an unreachable object is kept, 'gc.pruneGrace' by default"
+    )
+    parser.add_argument(
+        "--repack", action="store_true", help="pack the reachable objects into a single pack"
+    )
+
+
+def _add_check_ignore(parser):
+    parser.set_defaults(func=check_ignore)
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="show the matching pattern and its source"
+    )
+    parser.add_argument("paths", nargs="+")
+
+
+# Command name -> function adding its arguments to its parser
+COMMANDS = {
+    "init": _add_init,
+    "hash-object": _add_hash_object,
+    "cat-file": _add_cat_file,
+    "write-tree": _add_write_tree,
+    "read-tree": _add_read_tree,
+    "commit": _add_commit,
+    "log": _add_log,
+    "annotate": _add_annotate,
+    "checkout": _add_checkout,
+    "tag": _add_tag,
+    "k": _add_k,
+    "branch": _add_branch,
+    "status": _add_status,
+    "reset": _add_reset,
+    "show": _add_show,
+    "diff": _add_diff,
+    "merge": _add_merge,
+    "merge-base": _add_merge_base,
+    "fetch": _add_fetch,
+    "push": _add_push,
+    "fsmonitor": _add_fsmonitor,
+    "sparse-checkout": _add_sparse_checkout,
+    "migrate-objects": _add_migrate_objects,
+    "config": _add_config,
+    "commit-graph": _add_commit_graph,
+    "pack-refs": _add_pack_refs,
+    "repack": _add_repack,
+    "gc": _add_gc,
+    "check-ignore": _add_check_ignore,
+}
 
 
 def init(args):
+    from . import base, data
+
     base.init()
     print(f"Initialized ugit repository in {os.getcwd()}{os.sep}{data.GIT_DIR}")
 
 
 def hash_object(args):
-    with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+    from . import data
+
+    print(data.hash_file(args.file))
 
 
 def cat_file(args):
+    from . import data
+
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    if args.batch or args.batch_check:
+        _cat_file_batch(args)
+        return
+    for chunk in data.iter_object(args.object, expected=None):
+        sys.stdout.buffer.write(chunk)
+
+
+def _cat_file_batch(args):
+    """
+    Answer one object per line of stdin (an oid or a name) with a line
+    '<oid> <type> <size>', followed in --batch mode by the content and a
+    newline, or with a line '<name> missing' for an unknown object.
+    """
+    from . import data
+
+    out = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        name = line.rstrip(b"\r\n").decode()
+        oid = _resolve_batch_name(name)
+        try:
+            # An unknown object fails here, before anything is written
+            assert oid is not None
+            if args.batch_check:
+                type_, size = data.object_info(oid)
+            else:
+                type_, size, chunks = data.stream_object(oid)
+        except AssertionError:
+            out.write(f"{name} missing\n".encode())
+        else:
+            out.write(f"{oid} {type_} {size}\n".encode())
+            if args.batch:
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b"\n")
+        if not args.buffer:
+            out.flush()
+    out.flush()
+
+
+def _resolve_batch_name(name: str) -> str:
+    # Full oids are by far the most common input, skip the ref lookups
+    if len(name) == 40 and _HEX_DIGITS.issuperset(name):
+        return name
+    from . import base
+
+    try:
+        return base.get_oid(name)
+    except AssertionError:
+        return None
 
 
 def write_tree(args):
+    from . import base
+
     print(base.write_tree())
 
 
 def read_tree(args):
+    from . import base
+
     base.read_tree(args.tree)
 
 
 def commit(args):
+    from . import base
+
     print(base.commit(args.message))
 
 
-def _print_commit(oid: str, commit: base.Commit, refs: Iterable[str] = None):
+def _print_commit(oid: str, commit, refs: Iterable[str] = None):
+    import textwrap
+
     refs_str = f'({", ".join(refs)})' if refs else ""
     print(f"commit {oid}{refs_str}\n")
     print(textwrap.indent(commit.message, "     "))
     print("")
 
 
+def _parse_revision(name: str):
+    """
+    Resolve a revision to ([oids], [excluded oids]), None if it names no commit.
+    """
+    from . import base
+
+    start, dots, end = name.partition("..")
+    try:
+        if dots:
+            return [base.get_oid(end or "@")], [base.get_oid(start or "@")]
+        return [base.get_oid(name)], []
+    except AssertionError:
+        return None
+
+
 def log(args):
+    import itertools
+
+    from . import base, data
+
+    # The first argument is a revision when it names a commit, the rest are
+    # paths, which must be in the workspace unless they come after '--'
+    names = args.args
+    revision = _parse_revision(names[0]) if names else None
+    if revision is None:
+        revision = _parse_revision("@")
+    else:
+        names = names[1:]
+    for name in names:
+        assert os.path.lexists(name), (
+            f"Unknown revision or path not in the workspace: {name}, "
+            "use '--' to separate paths from revisions"
+        )
+    paths = names + args.paths
+    oids, exclude = revision
+    paths = [os.path.normpath(path).strip("/") for path in paths]
+    assert all(not path.startswith("..") for path in paths), "Paths must be inside the repository"
+
     # oid -> [refs]
     refs: Dict[str, Iterable[str]] = {}
     for refname, ref in data.iter_refs():
         refs.setdefault(ref.value, []).append(refname)
 
-    for oid in base.iter_commits_and_parents({args.oid}):
+    commits = base.iter_commits_and_parents(oids, exclude)
+    if paths and "." not in paths:
+        commits = base.iter_path_commits(commits, paths)
+    # Commits are printed as they are found, the history is walked only as
+    # far as the output goes
+    for oid in itertools.islice(commits, args.max_count):
         commit = base.get_commit(oid)
         _print_commit(oid, commit, refs.get(oid))
 
 
 def show(args):
+    from . import base, diff
+
     if not args.oid:
         return
     commit = base.get_commit(args.oid)
     parent_tree = None
     if commit.parents:
-        parent_tree = base.get_commit(commit.parent[0]).tree
+        parent_tree = base.get_commit(commit.parents[0]).tree
 
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree))
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_trees(base.iter_tree_changes(parent_tree, commit.tree)):
+        sys.stdout.buffer.write(chunk)
+
+
+def _annotate(args):
+    from . import annotate, base, data, diff
+
+    path = os.path.normpath(args.path)
+    origins = annotate.annotate(args.commit, path)
+    blob = base.get_path_oid(base.get_commit(args.commit).tree, path)
+    lines = diff.split_lines(data.get_object(blob, "blob"))
+    width = len(str(len(lines)))
+    out = sys.stdout.buffer
+    for number, (origin, line) in enumerate(zip(origins, lines), 1):
+        out.write(f"{origin.commit[:10]} {origin.line + 1:>{width}} {number:>{width}}) ".encode())
+        out.write(line if line.endswith(b"\n") else line + b"\n")
 
 
 def checkout(args):
+    from . import base
+
     base.checkout(args.commit)
 
 
 def tag(args):
+    from . import base
+
     base.create_tag(args.name, args.oid)
 
 
 def k(args):
+    import subprocess
+
+    from . import base, data
+
     dot = "digraph commits {\n"
 
     oids = set()
@@ -176,11 +515,16 @@ def k(args):
     dot += "}"
     print(dot)
     # TODO incompatible on Windows
-    with subprocess.Popen(["dot", "-Ttk", "/dev/stdin"], stdin=subprocess.PIPE) as proc:
+    trace.count("subprocess launches")
+    with trace.span("subprocess dot"), subprocess.Popen(
+        ["dot", "-Ttk", "/dev/stdin"], stdin=subprocess.PIPE
+    ) as proc:
         proc.communicate(dot.encode())
 
 
 def branch(args):
+    from . import base
+
     if not args.name:
         # show all branches
         current = base.get_branch_name()
@@ -193,6 +537,8 @@ def branch(args):
 
 
 def status(args):
+    from . import base, data, diff
+
     HEAD = base.get_oid("@")
     branch = base.get_branch_name()
     if branch:
@@ -206,27 +552,144 @@ def status(args):
 
     print("\nChanges to be committed:\n")
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    for path, action in diff.iter_changed_files(
-        base.get_tree(HEAD_tree), base.get_working_tree()
-    ):
+    changes = base.iter_tree_changes(HEAD_tree, base.write_tree(save_blobs=False))
+    for path, action in diff.iter_changed_files(changes):
         print(f"{action:>12}: {path}")
 
 
 def reset(args):
+    from . import base
+
     base.reset(args.commit)
 
 
 def _diff(args):
+    from . import base, diff
+
     tree = args.commit and base.get_commit(args.commit).tree
+    # The changed files are saved the way commit saves them, to diff their blobs
+    changes = list(base.iter_tree_changes(tree, base.write_tree()))
 
-    result = diff.diff_trees(base.get_tree(tree), base.get_working_tree())
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_trees(changes):
+        sys.stdout.buffer.write(chunk)
 
 
 def merge(args):
+    from . import base
+
     base.merge(args.commit)
 
 
 def merge_base(args):
-    print(base.get_merge_base(args.commit1, args.commit2))
\ No newline at end of file
+    from . import base
+
+    print(base.get_merge_base(args.commit1, args.commit2))
+
+
+def fetch(args):
+    from . import remote
+
+    branches = remote.fetch(args.remote)
+    for name, oid in sorted(branches.items()):
+        print(f"{remote.LOCAL_REFS_BASE}{name} {oid[:10]}")
+
+
+def push(args):
+    from . import remote
+
+    remote.push(args.remote, f"{remote.REMOTE_REFS_BASE}{args.branch}")
+
+
+def _fsmonitor(args):
+    from . import fsmonitor
+
+    if args.stop:
+        if not fsmonitor.stop():
+            print("No fsmonitor running")
+            sys.exit(1)
+        return
+    try:
+        fsmonitor.run(args.poll, args.interval or fsmonitor.DEFAULT_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+def sparse_checkout(args):
+    from . import base, sparse
+
+    if args.disable or args.directories:
+        base.set_sparse_checkout([] if args.disable else args.directories)
+        return
+    for prefix in sparse.get_prefixes():
+        print(prefix)
+
+
+def migrate_objects(args):
+    from . import data
+
+    count = data.migrate_objects()
+    print(f"Migrated {count} objects")
+
+
+def config(args):
+    from . import data
+
+    if args.value is None:
+        value = data.get_config(args.name)
+        if value is not None:
+            print(value)
+    else:
+        data.set_config(args.name, args.value)
+
+
+def write_commit_graph(args):
+    from . import commit_graph, data
+
+    oids = {ref.value for _, ref in data.iter_refs()}
+    commit_graph.rebuild(oids)
+    print(f"Wrote commit-graph with {commit_graph.get_graph().count} commits")
+
+
+def pack_refs(args):
+    from . import data
+
+    print(f"Packed {data.pack_refs()} refs")
+
+
+def repack(args):
+    from . import data, pack
+
+    name = pack.repack()
+    if name:
+        print(f"Packed objects into {os.path.relpath(name, data.GIT_DIR)}.pack")
+
+
+def _gc(args):
+    from . import gc
+
+    result = gc.gc(args.grace, args.repack)
+    print(f"{result.reachable} reachable objects, pruned {result.pruned} loose objects")
+    print(
+        f"Object store: {result.size_before} -> {result.size_after} bytes, "
+        f"reclaimed {result.size_before - result.size_after} bytes"
+    )
+
+
+def check_ignore(args):
+    from . import ignore
+
+    rules = ignore.Ignore()
+    found = False
+    for path in args.paths:
+        rule = rules.check(os.path.relpath(path).replace(os.sep, "/"), os.path.isdir(path))
+        if rule is None or (rule.negate and not args.verbose):
+            continue
+        found = found or not rule.negate
+        if args.verbose:
+            print(f"{rule.source or ''}:{rule.line or ''}:{rule.pattern}\t{path}")
+        else:
+            print(path)
+    # Same exit status as git, 1 when no path is ignored
+    if not found:
+        sys.exit(1)
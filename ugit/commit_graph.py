@@ -0,0 +1,297 @@
+"""Compact table of the commit history, saved as '.ugit/commit-graph'.
+
+The file is a header followed by fixed-size rows:
+    header: b"UCGR", version, number of sorted rows
+    row: commit oid, tree oid, first parent, second parent, generation
+
+Parents are row numbers (NO_PARENT if absent), and the generation of a
+commit is one more than the largest generation of its parents, 1 for a
+root commit. The first rows are sorted by oid and binary-searched through
+mmap, the rows after them were appended by later commits and are kept in
+insertion order, which is always parents first. The whole file is rewritten
+sorted once the appended tail grows too long.
+"""
+import mmap
+import os
+import struct
+
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+from . import data, trace
+
+MAGIC = b"UCGR"
+VERSION = 1
+NO_PARENT = 0xFFFFFFFF
+
+_HEADER = struct.Struct(">4sII")
+_ROW = struct.Struct(">20s20sIII")
+
+GraphCommit = namedtuple("GraphCommit", ["oid", "tree", "parents", "generation"])
+
+
+def _graph_path() -> str:
+    return f"{data.GIT_DIR}/commit-graph"
+
+
+class CommitGraph:
+    """
+    Read-only view of the commit-graph file.
+    """
+
+    __slots__ = ("count", "sorted_count", "_map", "_tail")
+
+    def __init__(self, path: str = None):
+        self.count = self.sorted_count = 0
+        self._map = None
+        # oid -> row of the appended rows, which are not sorted
+        self._tail: Dict[bytes, int] = {}
+        if path is None or not os.path.isfile(path):
+            return
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.sorted_count = _HEADER.unpack_from(self._map, 0)
+        assert magic == MAGIC and version == VERSION, "Bad commit-graph file"
+        # A partially appended row at the end is ignored
+        self.count = (len(self._map) - _HEADER.size) // _ROW.size
+        for i in range(self.sorted_count, self.count):
+            self._tail[self._oid_at(i)] = i
+
+    def _oid_at(self, i: int) -> bytes:
+        start = _HEADER.size + _ROW.size * i
+        return self._map[start:start + 20]
+
+    def find(self, oid: str) -> int:
+        """
+        Return the row of oid, None if the commit is not in the graph.
+        """
+        if not self.count:
+            return None
+        key = bytes.fromhex(oid)
+        lo, hi = 0, self.sorted_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(mid)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return mid
+        return self._tail.get(key)
+
+    def row(self, i: int) -> GraphCommit:
+        oid, tree, parent1, parent2, generation = _ROW.unpack_from(
+            self._map, _HEADER.size + _ROW.size * i
+        )
+        parents = [
+            self._oid_at(parent).hex() for parent in (parent1, parent2) if parent != NO_PARENT
+        ]
+        return GraphCommit(oid.hex(), tree.hex(), parents, generation)
+
+    def get(self, oid: str) -> GraphCommit:
+        i = self.find(oid)
+        return None if i is None else self.row(i)
+
+    def __iter__(self) -> Iterable[GraphCommit]:
+        for i in range(self.count):
+            yield self.row(i)
+
+
+_graph: CommitGraph = None
+_graph_git_dir = None
+
+
+def get_graph() -> CommitGraph:
+    global _graph, _graph_git_dir
+    if _graph is None or _graph_git_dir != data.GIT_DIR:
+        _graph, _graph_git_dir = CommitGraph(_graph_path()), data.GIT_DIR
+    return _graph
+
+
+def _invalidate():
+    global _graph
+    _graph = None
+
+
+def get_commit(oid: str) -> GraphCommit:
+    """
+    Return the GraphCommit of oid, None if it is not in the graph.
+    """
+    return get_graph().get(oid)
+
+
+def _parse_commit(oid: str):
+    """
+    Read (tree, parents) of a commit from the object database.
+    """
+    tree = None
+    parents = []
+    for line in data.get_object(oid, "commit").decode().splitlines():
+        if not line:
+            break
+        key, value = line.split(" ", 1)
+        if key == "tree":
+            tree = value
+        elif key == "parent":
+            parents.append(value)
+    # Commits have at most two parents, HEAD and MERGE_HEAD
+    assert len(parents) <= 2, f"Too many parents in {oid}"
+    return tree, parents
+
+
+def _missing_commits(oids: Iterable[str], graph: CommitGraph) -> List:
+    """
+    Return [(oid, tree, parents)] of the commits reachable from oids that are
+    not in the graph yet, parents before children.
+    """
+    result = []
+    parsed = {}
+    done = set()
+    stack = [oid for oid in oids if oid]
+    while stack:
+        oid = stack[-1]
+        if oid in done or graph.find(oid) is not None:
+            stack.pop()
+            continue
+        if oid not in parsed:
+            parsed[oid] = _parse_commit(oid)
+        pending = [
+            parent for parent in parsed[oid][1]
+            if parent not in done and graph.find(parent) is None
+        ]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        done.add(oid)
+        result.append((oid, *parsed[oid]))
+    return result
+
+
+@trace.timed()
+def add_commits(oids: Iterable[str]):
+    """
+    Make sure the commits and all their ancestors are in the graph,
+    appending the missing ones to the file.
+    """
+    graph = get_graph()
+    missing = _missing_commits(oids, graph)
+    if not missing:
+        return
+
+    tail_count = graph.count - graph.sorted_count
+    if graph.count == 0 or tail_count + len(missing) > max(64, graph.sorted_count // 8):
+        write_graph(list(graph) + missing)
+        return
+
+    # Rows of the commits being appended
+    rows = {}
+    generations = {}
+    with open(_graph_path(), "r+b") as f:
+        # Drop a row left partially written by an interrupted append
+        f.truncate(_HEADER.size + _ROW.size * graph.count)
+        f.seek(0, os.SEEK_END)
+        for i, (oid, tree, parents) in enumerate(missing, start=graph.count):
+            rows[oid] = i
+            parent_rows = []
+            generation = 1
+            for parent in parents:
+                parent_row = rows.get(parent, graph.find(parent))
+                parent_rows.append(parent_row)
+                parent_generation = generations.get(parent) or graph.row(parent_row).generation
+                generation = max(generation, parent_generation + 1)
+            generations[oid] = generation
+            parent_rows += [NO_PARENT] * (2 - len(parent_rows))
+            f.write(
+                _ROW.pack(bytes.fromhex(oid), bytes.fromhex(tree), *parent_rows, generation)
+            )
+    _invalidate()
+
+
+def get_graph_of(oids: Iterable[str], update: bool = True):
+    """
+    Return a graph holding the commits of oids and all their ancestors. The
+    missing ones are appended to the file, or with update False only kept in
+    memory, for a repository that must be left untouched.
+    """
+    if update:
+        add_commits(oids)
+        return get_graph()
+    graph = get_graph()
+    return _ExtendedGraph(graph, _missing_commits(oids, graph))
+
+
+class _ExtendedGraph:
+    """
+    A graph with some commits added in memory.
+    """
+
+    __slots__ = ("_graph", "_added")
+
+    def __init__(self, graph: CommitGraph, missing: List):
+        self._graph = graph
+        self._added: Dict[str, GraphCommit] = {}
+        # Parents come before children
+        for oid, tree, parents in missing:
+            generation = 1 + max((self.get(parent).generation for parent in parents), default=0)
+            self._added[oid] = GraphCommit(oid, tree, parents, generation)
+
+    def get(self, oid: str) -> GraphCommit:
+        commit = self._added.get(oid)
+        return commit if commit is not None else self._graph.get(oid)
+
+
+@trace.timed()
+def write_graph(commits: List):
+    """
+    Rewrite the whole graph sorted by oid from a list of GraphCommit or
+    (oid, tree, parents), which must contain all the ancestors of each commit.
+    """
+    by_oid = {commit[0]: commit for commit in commits}
+    order = sorted(by_oid)
+    rows = {oid: i for i, oid in enumerate(order)}
+
+    generations = {}
+
+    def generation(oid: str) -> int:
+        # Iterative, history can be far deeper than the recursion limit
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            parents = by_oid[current][2]
+            pending = [parent for parent in parents if parent not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            generations[current] = 1 + max(
+                (generations[parent] for parent in parents), default=0
+            )
+        return generations[oid]
+
+    tmp = f"{_graph_path()}.lock"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(order)))
+        for oid in order:
+            _, tree, parents = by_oid[oid][:3]
+            parent_rows = [rows[parent] for parent in parents]
+            parent_rows += [NO_PARENT] * (2 - len(parent_rows))
+            f.write(
+                _ROW.pack(
+                    bytes.fromhex(oid), bytes.fromhex(tree), *parent_rows, generation(oid)
+                )
+            )
+    os.replace(tmp, _graph_path())
+    _invalidate()
+
+
+def rebuild(oids: Iterable[str]):
+    """
+    Write a new graph of all commits reachable from oids.
+    """
+    write_graph(_missing_commits(oids, CommitGraph()))
@@ -1,12 +1,30 @@
 """Manage the disk related operation.
 """
+import bisect
+import contextlib
 import os
-import hashlib
+import string
+import zlib
 
-from collections import namedtuple
-from typing import Iterable, Tuple
+from collections import namedtuple, OrderedDict
+from typing import Callable, Iterable, List, Tuple
+
+from . import pack, trace
 
 GIT_DIR = ".ugit"
+# Buffer size of streamed object reads and writes
+CHUNK_SIZE = 1 << 16
+
+# A chunked blob is stored as a manifest object of this type under the oid of
+# the whole blob, listing the blobs of its content-defined chunks
+CHUNKED = "chunked"
+MIN_CHUNK = 16 << 10
+MAX_CHUNK = 256 << 10
+# Bytes whose table bits must match the boundary pattern, cuts happen every
+# 2**16 bytes past MIN_CHUNK on average
+_CHUNK_WINDOW = 16
+# File buffer of the chunker
+_CHUNKER_READ_SIZE = 4 << 20
 
 
 def init():
@@ -17,9 +35,92 @@ def init():
     os.makedirs(f"{GIT_DIR}/objects")
 
 
+@contextlib.contextmanager
+def change_git_dir(path: str):
+    """
+    Work on the repository at path, whose workspace is path, until the end of
+    the block.
+    """
+    global GIT_DIR
+    old_dir = GIT_DIR
+    GIT_DIR = f"{path}/.ugit"
+    try:
+        yield
+    finally:
+        GIT_DIR = old_dir
+
+
+def get_config(name: str, default=None) -> str:
+    """
+    Get a 'section.key' value from '.ugit/config', default if not set.
+    """
+    section, key = name.rsplit(".", 1)
+    return _read_config().get(section, key, fallback=default)
+
+
+def set_config(name: str, value: str):
+    section, key = name.rsplit(".", 1)
+    config = _read_config()
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, key, value)
+    with open(f"{GIT_DIR}/config", "w") as f:
+        config.write(f)
+
+
+def _read_config():
+    # Imported on demand, to keep the startup of commands that need no config short
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read(f"{GIT_DIR}/config")
+    return config
+
+
+class LRUCache:
+    """
+    Least recently used cache bounded by a memory budget in bytes, where
+    the cost of every value is estimated by sizeof.
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable = len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """
+        Return the cached value of key, None if not cached.
+        """
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value[0]
+
+    def put(self, key, value):
+        cost = self.sizeof(value)
+        if cost > self.max_bytes or key in self._items:
+            return
+        self._items[key] = (value, cost)
+        self.size += cost
+        while self.size > self.max_bytes:
+            _, (_, old_cost) = self._items.popitem(last=False)
+            self.size -= old_cost
+
+    def __len__(self):
+        return len(self._items)
+
+
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
 
 
+@trace.timed()
 def update_ref(ref: str, value: RefValue, deref: bool = True):
     """
     Update reference, dereference by default.
@@ -34,10 +135,11 @@ def update_ref(ref: str, value: RefValue, deref: bool = True):
 
     ref_path = f"{GIT_DIR}/{ref}"
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, "w") as f:
+    with _LockFile(ref_path) as f:
         f.write(val)
 
 
+@trace.timed()
 def get_ref(ref: str, deref: bool = True) -> RefValue:
     """
     Get reference value, which is oid, dereference by default. Return None if no such reference.
@@ -47,13 +149,16 @@ def get_ref(ref: str, deref: bool = True) -> RefValue:
 
 def _get_ref_internal(ref: str, deref: bool) -> Tuple[str, RefValue]:
     """
-    Dereference and get the last non-symbolic ref, which points directly to a commit
+    Dereference and get the last non-symbolic ref, which points directly to a commit.
+    A loose ref file overrides the same ref in packed-refs.
     """
     ref_path = f"{GIT_DIR}/{ref}"
     value = None
-    if os.path.isfile(ref_path):
+    try:
         with open(ref_path) as f:
             value = f.read().strip()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        value = _get_packed_refs().get(ref)
 
     is_symbolic = bool(value) and value.startswith("ref:")
     if is_symbolic:
@@ -65,42 +170,646 @@ def _get_ref_internal(ref: str, deref: bool) -> Tuple[str, RefValue]:
     return ref, RefValue(symbolic=is_symbolic, value=value)
 
 
-def hash_object(data: bytes, type_="blob") -> str:
+class _LockFile:
+    """
+    Exclusive '<path>.lock' file, renamed over path on success so readers
+    never see a partial write, removed on failure.
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.fsync = fsync
+        try:
+            fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            assert False, f"Unable to lock {path}, {self.lock_path} exists"
+        self.file = os.fdopen(fd, "w")
+
+    def write(self, content: str):
+        self.file.write(content)
+
+    def commit(self):
+        if self.fsync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.lock_path, self.path)
+
+    def rollback(self):
+        self.file.close()
+        os.remove(self.lock_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class _PackedRefs:
+    """
+    Content of '.ugit/packed-refs', lines of 'oid refname' sorted by refname.
+    """
+
+    def __init__(self, names=None, values=None):
+        self.names = names or []
+        self.values = values or []
+
+    def get(self, ref: str) -> str:
+        i = bisect.bisect_left(self.names, ref)
+        if i < len(self.names) and self.names[i] == ref:
+            return self.values[i]
+        return None
+
+    def items(self) -> Iterable[Tuple[str, str]]:
+        return zip(self.names, self.values)
+
+
+# Parsed packed-refs, reused as long as the file is unchanged
+_packed_refs_cache = (None, None)
+
+
+def _packed_refs_path() -> str:
+    return f"{GIT_DIR}/packed-refs"
+
+
+def _get_packed_refs() -> _PackedRefs:
+    global _packed_refs_cache
+    path = _packed_refs_path()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return _PackedRefs()
+    key = (path, st.st_mtime_ns, st.st_size, st.st_ino)
+    if _packed_refs_cache[0] == key:
+        return _packed_refs_cache[1]
+
+    names, values = [], []
+    with open(path) as f:
+        for line in f:
+            value, name = line.rstrip("\n").split(" ", 1)
+            names.append(name)
+            values.append(value)
+    packed = _PackedRefs(names, values)
+    _packed_refs_cache = (key, packed)
+    return packed
+
+
+def _write_packed_refs(lock: _LockFile, refs: dict):
+    for name in sorted(refs):
+        lock.write(f"{refs[name]} {name}\n")
+
+
+def _iter_loose_refnames(prefix: str = "") -> Iterable[str]:
+    # Only walk the part of refs/ that can match prefix
+    directory = os.path.dirname(prefix) if prefix.startswith("refs/") else "refs"
+    for root, _, filenames in os.walk(f"{GIT_DIR}/{directory}"):
+        root = os.path.relpath(root, GIT_DIR)
+        for name in filenames:
+            if not name.endswith(".lock"):
+                yield f"{root}/{name}"
+
+
+class RefTransaction:
+    """
+    Batch of ref updates applied together. Plain refs under 'refs/' are all
+    written to packed-refs with a single write and fsync, other refs (HEAD,
+    symbolic refs) are written as loose refs.
+    """
+
+    def __init__(self):
+        self.updates = {}
+
+    def update(self, ref: str, value: RefValue, deref: bool = True):
+        assert value.value
+        ref = _get_ref_internal(ref, deref)[0]
+        self.updates[ref] = value
+
+    def delete(self, ref: str, deref: bool = True):
+        ref = _get_ref_internal(ref, deref)[0]
+        self.updates[ref] = None
+
+    def commit(self):
+        packed_updates = {
+            ref: value for ref, value in self.updates.items()
+            if ref.startswith("refs/") and not (value and value.symbolic)
+        }
+        loose_updates = {
+            ref: value for ref, value in self.updates.items() if ref not in packed_updates
+        }
+
+        # Take every lock first, so nothing is changed if one of them is taken.
+        # Refs going to packed-refs are covered by its lock alone, a lock per
+        # ref would keep a descriptor open for each of them.
+        locks = []
+        try:
+            packed_lock = _LockFile(_packed_refs_path(), fsync=True)
+            locks.append(packed_lock)
+            loose_locks = {}
+            for ref in loose_updates:
+                os.makedirs(os.path.dirname(f"{GIT_DIR}/{ref}"), exist_ok=True)
+                loose_locks[ref] = _LockFile(f"{GIT_DIR}/{ref}")
+                locks.append(loose_locks[ref])
+        except BaseException:
+            for lock in locks:
+                lock.rollback()
+            raise
+
+        refs = dict(_get_packed_refs().items())
+        for ref, value in packed_updates.items():
+            if value is None:
+                refs.pop(ref, None)
+            else:
+                refs[ref] = value.value
+        _write_packed_refs(packed_lock, refs)
+        packed_lock.commit()
+        # A loose file must not shadow the packed value. It is removed only once
+        # packed-refs holds the new value, removing it first would let readers
+        # see the old packed value, or a deleted ref come back.
+        for ref in packed_updates:
+            if os.path.isfile(f"{GIT_DIR}/{ref}"):
+                os.remove(f"{GIT_DIR}/{ref}")
+
+        for ref, lock in loose_locks.items():
+            value = loose_updates[ref]
+            if value is None:
+                lock.rollback()
+                if os.path.isfile(f"{GIT_DIR}/{ref}"):
+                    os.remove(f"{GIT_DIR}/{ref}")
+            else:
+                lock.write(f"ref: {value.value}" if value.symbolic else value.value)
+                lock.commit()
+        self.updates = {}
+
+
+def pack_refs() -> int:
+    """
+    Move all plain loose refs under 'refs/' into packed-refs, return how many were packed.
+    """
+    with _LockFile(_packed_refs_path(), fsync=True) as lock:
+        refs = dict(_get_packed_refs().items())
+        packed = []
+        for refname in _iter_loose_refnames():
+            with open(f"{GIT_DIR}/{refname}") as f:
+                value = f.read().strip()
+            if value and not value.startswith("ref:"):
+                refs[refname] = value
+                packed.append(refname)
+        _write_packed_refs(lock, refs)
+
+    for refname in packed:
+        os.remove(f"{GIT_DIR}/{refname}")
+        try:
+            os.removedirs(os.path.dirname(f"{GIT_DIR}/{refname}"))
+        except OSError:
+            pass
+    return len(packed)
+
+
+@trace.timed()
+def hash_object(data: bytes, type_="blob", write: bool = True) -> str:
     """
     Content-addressable storage, save data to a new file with name of hash(data), return object id.
     The object structure: type00data
+    Only compute the object id without touching the object database if write is False.
     """
+    # Loading OpenSSL is slow, commands that never hash should not pay for it
+    import hashlib
+
     obj = type_.encode() + b"\x00" + data
     oid = hashlib.sha1(obj).hexdigest()
-    path = f"{GIT_DIR}/objects/{oid}"
+    trace.count("bytes hashed", len(data))
+    if not write or freshen_object(oid):
+        return oid
+
+    _write_loose_object(oid, zlib.compress(obj))
+    return oid
+
+
+@trace.timed()
+def hash_file(path: str, type_="blob", write: bool = True) -> str:
+    """
+    Same as hash_object on the content of path, but streams the file in
+    CHUNK_SIZE buffers, so memory stays constant whatever the file size.
+    """
+    import hashlib
+
+    header = type_.encode() + b"\x00"
+    sha = hashlib.sha1(header)
+    if not write:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+                trace.count("bytes hashed", len(chunk))
+        return sha.hexdigest()
+
+    compressor = zlib.compressobj()
+    fd, tmp = _make_temp_object()
+    try:
+        with os.fdopen(fd, "wb") as out, open(path, "rb") as f:
+            out.write(compressor.compress(header))
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+                trace.count("bytes hashed", len(chunk))
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+        oid = sha.hexdigest()
+        if freshen_object(oid):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(_object_path(oid)), exist_ok=True)
+            os.replace(tmp, _object_path(oid))
+            trace.count("objects written")
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return oid
+
+
+@trace.timed()
+def hash_chunked_file(path: str) -> str:
+    """
+    Save path as a chunked blob: each content-defined chunk is saved as a blob
+    of its own, so a chunk shared with another version is stored once. Return
+    the oid of the whole content, the same as hash_file.
+    """
+    import hashlib
 
-    with open(path, "wb") as out:
-        out.write(obj)
+    sha = hashlib.sha1(b"blob\x00")
+    manifest = []
+    with open(path, "rb") as f:
+        for chunk in iter_content_chunks(f):
+            sha.update(chunk)
+            manifest.append(f"{hash_object(chunk)} {len(chunk)}\n")
+    oid = sha.hexdigest()
+    if not freshen_object(oid):
+        obj = f"{CHUNKED}\x00{''.join(manifest)}".encode()
+        _write_loose_object(oid, zlib.compress(obj))
     return oid
 
 
+_chunk_table = None
+
+
+def _get_chunk_table() -> Tuple[bytes, bytes]:
+    """
+    Return (table mapping every byte to a 0 or 1 byte, boundary pattern).
+    Half of the byte values map to 1, picked by a hash so they are spread
+    evenly whatever the data.
+    """
+    global _chunk_table
+    if _chunk_table is None:
+        import hashlib
+
+        ranked = sorted(range(256), key=lambda byte: hashlib.sha1(bytes([byte])).digest())
+        table = bytearray(256)
+        for byte in ranked[:128]:
+            table[byte] = 1
+        pattern = bytes((0x5A3C >> i) & 1 for i in range(_CHUNK_WINDOW))
+        _chunk_table = bytes(table), pattern
+    return _chunk_table
+
+
+def iter_content_chunks(f) -> Iterable[bytes]:
+    """
+    Split a file into chunks whose boundaries depend on the content around
+    them, so an edit only changes the chunks it touches. A chunk ends after
+    _CHUNK_WINDOW bytes whose table bits form the boundary pattern, a rolling
+    hash of the window evaluated for every position at once by bytes.translate
+    and bytes.find. Chunks are MIN_CHUNK to MAX_CHUNK bytes, except the last.
+    """
+    table, pattern = _get_chunk_table()
+    buf = bits = b""
+    pos = 0
+    while True:
+        if len(buf) - pos < MAX_CHUNK:
+            block = f.read(_CHUNKER_READ_SIZE)
+            if block:
+                buf = buf[pos:] + block
+                bits = bits[pos:] + block.translate(table)
+                pos = 0
+                continue
+            if pos == len(buf):
+                return
+        match = bits.find(pattern, pos + MIN_CHUNK - _CHUNK_WINDOW, pos + MAX_CHUNK)
+        end = match + _CHUNK_WINDOW if match >= 0 else min(pos + MAX_CHUNK, len(buf))
+        yield buf[pos:end]
+        pos = end
+
+
+def _make_temp_object() -> Tuple[int, str]:
+    """
+    Create a temporary file among the objects, return (fd, path).
+    """
+    # tempfile pulls in random and shutil, only commands writing objects need it
+    import tempfile
+
+    return tempfile.mkstemp(dir=f"{GIT_DIR}/objects", prefix="tmp_obj_")
+
+
+def _object_path(oid: str) -> str:
+    """
+    Objects are fanned out to directories named by the first two hex digits of oid.
+    """
+    return f"{GIT_DIR}/objects/{oid[:2]}/{oid[2:]}"
+
+
+def _legacy_object_path(oid: str) -> str:
+    """
+    Flat and uncompressed layout of the object database before fan-out.
+    """
+    return f"{GIT_DIR}/objects/{oid}"
+
+
+def _write_loose_object(oid: str, compressed: bytes):
+    """
+    Write through a temporary file and rename, so a crash never leaves a truncated object.
+    """
+    path = _object_path(oid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = _make_temp_object()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(compressed)
+        os.replace(tmp, path)
+        trace.count("objects written")
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def object_exists(oid: str) -> bool:
+    return (
+        pack.has_object(oid)
+        or os.path.isfile(_object_path(oid))
+        or os.path.isfile(_legacy_object_path(oid))
+        or pack.has_object(oid, reload=True)
+    )
+
+
+def freshen_object(oid: str) -> bool:
+    """
+    Same as object_exists, but also set the modification time of the object,
+    or of its pack, to now. An object about to be referenced again is so kept
+    by gc for another grace period, as if it had just been written.
+    """
+    if pack.freshen_object(oid):
+        return True
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            pass
+    return pack.freshen_object(oid, reload=True)
+
+
+@trace.timed()
+def read_object(oid: str) -> bytes:
+    """
+    Read the raw object (type00data) from packs or loose objects.
+    """
+    obj = pack.read_object(oid)
+    if obj is not None:
+        return obj
+    try:
+        with open(_object_path(oid), "rb") as f:
+            return zlib.decompress(f.read())
+    except FileNotFoundError:
+        pass
+    try:
+        with open(_legacy_object_path(oid), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    # The object might have been packed by another process meanwhile
+    obj = pack.read_object(oid, reload=True)
+    assert obj is not None, f"Object {oid} not found"
+    return obj
+
+
+def iter_decompressed(chunks: Iterable[bytes]) -> Iterable[bytes]:
+    """
+    Decompress a zlib stream, yielding at most CHUNK_SIZE bytes at a time.
+    """
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            out = decompressor.decompress(chunk, CHUNK_SIZE)
+            if out:
+                yield out
+            chunk = decompressor.unconsumed_tail
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def object_info(oid: str, raw: bool = False) -> Tuple[str, int]:
+    """
+    Return (type, content size) of an object, streaming through its content.
+    A chunked blob is a blob of the size of its content, unless raw is True.
+    """
+    chunks = iter_raw_object(oid)
+    header = b""
+    for chunk in chunks:
+        header += chunk
+        if b"\x00" in header:
+            break
+    type_, _, content = header.partition(b"\x00")
+    type_ = type_.decode()
+    if type_ == CHUNKED and not raw:
+        manifest = _parse_manifest(content + b"".join(chunks))
+        return "blob", sum(size for _, size in manifest)
+    return type_, len(content) + sum(len(chunk) for chunk in chunks)
+
+
+def object_type(oid: str) -> str:
+    """
+    Return the stored type of an object, CHUNKED for a chunked blob, reading
+    only the start of it.
+    """
+    chunks = iter_raw_object(oid)
+    header = b""
+    for chunk in chunks:
+        header += chunk
+        if b"\x00" in header:
+            break
+    chunks.close()
+    return header.partition(b"\x00")[0].decode()
+
+
+def _parse_manifest(content: bytes) -> List[Tuple[str, int]]:
+    """
+    Return [(chunk oid, size)] of a chunked blob manifest.
+    """
+    manifest = []
+    for line in content.decode().splitlines():
+        oid, size = line.split(" ")
+        manifest.append((oid, int(size)))
+    return manifest
+
+
+def get_chunks(oid: str) -> List[str]:
+    """
+    Return the oids of the chunks of a blob, None if it is not chunked.
+    """
+    if object_type(oid) != CHUNKED:
+        return None
+    return [chunk for chunk, _ in _parse_manifest(read_object(oid).partition(b"\x00")[2])]
+
+
+@trace.timed()
+def iter_raw_object(oid: str) -> Iterable[bytes]:
+    """
+    Stream the raw object (type00data) in chunks of about CHUNK_SIZE.
+    """
+    chunks = pack.iter_object(oid)
+    if chunks is not None:
+        yield from chunks
+        return
+    try:
+        f = open(_object_path(oid), "rb")
+    except FileNotFoundError:
+        f = None
+    if f is not None:
+        with f:
+            yield from iter_decompressed(iter(lambda: f.read(CHUNK_SIZE), b""))
+        return
+    try:
+        f = open(_legacy_object_path(oid), "rb")
+    except FileNotFoundError:
+        f = None
+    if f is not None:
+        with f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+        return
+    yield read_object(oid)
+
+
+def stream_object(oid: str) -> Tuple[str, int, Iterable[bytes]]:
+    """
+    Return (type, content size, content chunks) of an object. An object that
+    fits in a few chunks is read once, a larger one is sized in a first pass
+    over its content and streamed again in a second.
+    """
+    chunks = iter_raw_object(oid)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > CHUNK_SIZE:
+            break
+    else:
+        type_, _, content = b"".join(head).partition(b"\x00")
+        type_ = type_.decode()
+        if type_ == CHUNKED:
+            manifest = _parse_manifest(content)
+            return "blob", sum(size for _, size in manifest), _iter_chunked(manifest)
+        return type_, len(content), (content,)
+    chunks.close()
+    type_, size = object_info(oid)
+    return type_, size, iter_object(oid, expected=None)
+
+
+def iter_object(oid: str, expected="blob") -> Iterable[bytes]:
+    """
+    Stream the content of an object, the streaming counterpart of get_object.
+    """
+    chunks = iter_raw_object(oid)
+    header = b""
+    for chunk in chunks:
+        header += chunk
+        if b"\x00" in header:
+            break
+    type_, _, content = header.partition(b"\x00")
+    type_ = type_.decode()
+    if type_ == CHUNKED:
+        assert expected in (None, "blob"), f"Expected {expected}, got blob"
+        # Only one chunk is in memory at a time
+        yield from _iter_chunked(_parse_manifest(content + b"".join(chunks)))
+        return
+    if expected is not None:
+        assert type_ == expected, f"Expected {expected}, got {type_}"
+
+    if content:
+        yield content
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def _iter_chunked(manifest: List[Tuple[str, int]]) -> Iterable[bytes]:
+    for chunk, _ in manifest:
+        yield from iter_object(chunk)
+
+
+def iter_loose_objects() -> Iterable[str]:
+    """
+    Yield the oid of every loose object, in both the fan-out and legacy layout.
+    """
+    with os.scandir(f"{GIT_DIR}/objects") as it:
+        for entry in it:
+            if entry.is_file() and len(entry.name) == 40:
+                yield entry.name
+            elif entry.is_dir() and len(entry.name) == 2:
+                for filename in os.listdir(entry.path):
+                    if len(filename) == 38:
+                        yield entry.name + filename
+
+
+def loose_object_mtime(oid: str) -> float:
+    """
+    Modification time of a loose object, None if it is not stored loose.
+    """
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            pass
+    return None
+
+
+def remove_loose_object(oid: str):
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        if os.path.isfile(path):
+            os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(_object_path(oid)))
+    except OSError:
+        # Other objects share the fan-out directory
+        pass
+
+
 def get_object(oid: str, expected="blob") -> bytes:
     """
     Get the file content by oid, note that the object type should meet the expected type.
     """
-    with open(f"{GIT_DIR}/objects/{oid}", "rb") as f:
-        obj = f.read()
+    obj = read_object(oid)
     type_, _, content = obj.partition(b"\x00")
     type_ = type_.decode()
+    if type_ == CHUNKED:
+        type_ = "blob"
+        content = b"".join(get_object(chunk) for chunk, _ in _parse_manifest(content))
 
     if expected is not None:
         assert type_ == expected, f"Expected {expected}, got {type_}"
     return content
 
 
+@trace.timed()
 def iter_refs(prefix: str = "", deref: bool = True) -> Iterable[Tuple[str, RefValue]]:
     """
     A generator that iterates all refs and yields (refname, RefValue)
     """
     refs = ["HEAD", "MERGE_HEAD"]
-    for root, _, filenames in os.walk(f"{GIT_DIR}/refs/"):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f"{root}/{name}" for name in filenames)
+    loose = set(_iter_loose_refnames(prefix))
+    refs.extend(sorted(loose.union(name for name, _ in _get_packed_refs().items())))
 
     for refname in refs:
         if not refname.startswith(prefix):
@@ -112,4 +821,31 @@ def iter_refs(prefix: str = "", deref: bool = True) -> Iterable[Tuple[str, RefVa
 
 def delete_ref(ref: str, deref: bool = True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GIT_DIR}/{ref}")
+    # packed-refs first, so the ref never falls back to its packed value
+    if _get_packed_refs().get(ref) is not None:
+        with _LockFile(_packed_refs_path(), fsync=True) as lock:
+            refs = dict(_get_packed_refs().items())
+            refs.pop(ref, None)
+            _write_packed_refs(lock, refs)
+    if os.path.isfile(f"{GIT_DIR}/{ref}"):
+        os.remove(f"{GIT_DIR}/{ref}")
+
+
+def migrate_objects() -> int:
+    """
+    Convert objects stored in the legacy flat layout to compressed fan-out objects,
+    return the number of migrated objects.
+    """
+    count = 0
+    with os.scandir(f"{GIT_DIR}/objects") as it:
+        names = [entry.name for entry in it if entry.is_file()]
+    for oid in names:
+        if len(oid) != 40 or not all(c in string.hexdigits for c in oid):
+            continue
+        legacy_path = _legacy_object_path(oid)
+        if not os.path.isfile(_object_path(oid)):
+            with open(legacy_path, "rb") as f:
+                _write_loose_object(oid, zlib.compress(f.read()))
+        os.remove(legacy_path)
+        count += 1
+    return count
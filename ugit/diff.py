@@ -1,105 +1,379 @@
 """ Module that deals with computing differences between objects.
 """
 
-import subprocess
-import os
+import re
 
-from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
-from typing import Iterable, Dict, Tuple, AnyStr
+from typing import Iterable, Dict, Tuple, AnyStr, List
 
-from . import data
+from . import data, trace
 
 
-def compare_trees(*trees):
+def iter_changed_files(changes: Iterable[Tuple[str, str, str]]) -> Iterable[Tuple[str, str]]:
     """
-    Take a list of trees, and return them as OIDs grouped by filename.
+    Take (path, from oid, to oid) changes, as from base.iter_tree_changes,
+    and yield (path, action).
     """
-    entries = defaultdict(lambda: [None] * len(trees))
-    for i, tree in enumerate(trees):
-        for path, oid in tree.items():
-            entries[path][i] = oid
-
-    for path, oids in entries.items():
-        yield (path, *oids)
-
-
-def iter_changed_files(t_from, t_to) -> Iterable[Tuple[str, str]]:
-    for path, o_from, o_to in compare_trees(t_from, t_to):
+    for path, o_from, o_to in changes:
         if o_from != o_to:
             action = "new file" if not o_from else "deleted" if not o_to else "modified"
             yield path, action
 
 
-def diff_trees(t_from: Dict[str, str], t_to: Dict[str, str]):
+def diff_trees(changes: Iterable[Tuple[str, str, str]]) -> Iterable[bytes]:
     """
-    Take two trees, compares them and return all entries that
-    have differenct OIDs.
+    Take (path, from oid, to oid) changes and yield the diff of all entries
+    that have differenct OIDs, chunk by chunk.
     """
-    output = b""
-    for (
-            path,
-            o_from,
-            o_to,
-    ) in compare_trees(t_from, t_to):
+    for path, o_from, o_to in changes:
         if o_from != o_to:
-            # output += f"changed: {path}\n"
-            output += diff_blobs(o_from, o_to, path)
-    return output
-
-
-def diff_blobs(o_from, o_to, path="blob"):
-    # TODO use `difflib` instead of Unix diff
-    with Temp(delete=False) as f_from, Temp(delete=False) as f_to:
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-        with subprocess.Popen(
-            [   "diff", "--unified",
-                "--show-c-function",
-                "--label", f"a/{path}", 
-                f_from.name,
-                "--label", f"b/{path}",
-                f_to.name,
-            ],
-                stdout=subprocess.PIPE,
-        ) as proc:
-            output, _ = proc.communicate()
-    # Mannually remove the tempfiles due to Windows file permission issues
-    os.remove(f_from.name)
-    os.remove(f_to.name)
-    return output
-
-
-def merge_trees(t_HEAD, t_other, t_base) -> Dict[str, AnyStr]:
-    tree = {}
-    for path, o_HEAD, o_other, o_base in compare_trees(t_HEAD, t_other, t_base):
-        tree[path] = merge_blobs(o_HEAD, o_other, o_base)
-    return tree
+            yield from diff_blobs(o_from, o_to, path)
+
+
+# Number of unchanged lines around a change
+CONTEXT = 3
+# Bytes inspected for a NUL to tell binary blobs
+BINARY_CHECK_SIZE = 8000
+# Hunk headers show the last line before the hunk that looks like a
+# function definition, same as `diff --show-c-function`
+_FUNCTION_LINE = re.compile(rb"^[A-Za-z$_]")
+_FUNCTION_WIDTH = 40
+_NO_NEWLINE = b"\\ No newline at end of file\n"
+
+
+def diff_blobs(o_from, o_to, path="blob") -> Iterable[bytes]:
+    """
+    Yield the unified diff of two blobs, a missing blob (None) is taken as empty.
+    """
+    b_from = data.get_object(o_from) if o_from else b""
+    b_to = data.get_object(o_to) if o_to else b""
+    yield from unified_diff(b_from, b_to, f"a/{path}".encode(), f"b/{path}".encode())
+
+
+def split_lines(content: bytes) -> List[bytes]:
+    """
+    Split content into lines that keep their '\n'. Unlike bytes.splitlines,
+    a '\r' or any other line boundary is part of the line.
+    """
+    lines = content.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def is_binary(content: bytes) -> bool:
+    return b"\x00" in content[:BINARY_CHECK_SIZE]
+
+
+@trace.timed()
+def unified_diff(b_from: bytes, b_to: bytes, label_from: bytes, label_to: bytes) -> Iterable[bytes]:
+    if b_from == b_to:
+        return
+    if is_binary(b_from) or is_binary(b_to):
+        yield b"Binary files " + label_from + b" and " + label_to + b" differ\n"
+        return
+
+    a = split_lines(b_from)
+    b = split_lines(b_to)
+    yield b"--- " + label_from + b"\n"
+    yield b"+++ " + label_to + b"\n"
 
+    function_line = b""
+    function_searched = 0
+    for hunk in _iter_hunks(diff_lines(a, b)):
+        (a_start, a_count), (b_start, b_count) = hunk[0], hunk[1]
+        # Search backwards for the function line, remembering what was found
+        for i in range(a_start - 1, function_searched - 1, -1):
+            if _FUNCTION_LINE.match(a[i]):
+                function_line = a[i].rstrip(b"\r\n")[:_FUNCTION_WIDTH].rstrip()
+                break
+        function_searched = a_start
+        header = b"@@ -" + _hunk_range(a_start, a_count) + b" +" + _hunk_range(b_start, b_count) + b" @@"
+        if function_line:
+            header += b" " + function_line
+        yield header + b"\n"
+
+        for tag, line in hunk[2]:
+            yield tag + line
+            if not line.endswith(b"\n"):
+                yield b"\n" + _NO_NEWLINE
+
+
+def _hunk_range(start: int, count: int) -> bytes:
+    if count == 1:
+        return str(start + 1).encode()
+    # An empty range refers to the line before it
+    return f"{start + 1 if count else start},{count}".encode()
+
+
+def _iter_hunks(ops: List[Tuple[bytes, int, int, bytes]]):
+    """
+    Group the operations of diff_lines into hunks with CONTEXT lines around
+    changes, yield ((a start, a count), (b start, b count), [(tag, line)]).
+    """
+    changes = [i for i, op in enumerate(ops) if op[0] != b" "]
+    if not changes:
+        return
+    groups = []
+    first = last = changes[0]
+    for i in changes[1:]:
+        if i - last > 2 * CONTEXT:
+            groups.append((first, last))
+            first = i
+        last = i
+    groups.append((first, last))
+
+    for first, last in groups:
+        start = max(first - CONTEXT, 0)
+        end = min(last + CONTEXT + 1, len(ops))
+        a_count = b_count = 0
+        lines = []
+        for tag, _, _, line in ops[start:end]:
+            if tag != b"+":
+                a_count += 1
+            if tag != b"-":
+                b_count += 1
+            lines.append((tag, line))
+        # Position of the hunk in both files, even when one side is empty
+        _, a_start, b_start, _ = ops[start]
+        yield (a_start, a_count), (b_start, b_count), lines
+
+
+@trace.timed()
+def diff_lines(a: List[bytes], b: List[bytes]) -> List[Tuple[bytes, int, int, bytes]]:
+    """
+    Diff two lists of lines with Myers' algorithm, return a list of
+    (tag, a index, b index, line) where tag is b" ", b"-" or b"+", and the
+    index is the position in each file when the operation is reached.
+    """
+    # Compare small integers instead of lines
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    # Lines without a counterpart on the other side are always changed, leaving
+    # them out keeps Myers fast when files have little in common.
+    a_set, b_set = set(a_ids), set(b_ids)
+    a_keep = [i for i, line in enumerate(a_ids) if line in b_set]
+    b_keep = [j for j, line in enumerate(b_ids) if line in a_set]
+    a_kept_changed = [False] * len(a_keep)
+    b_kept_changed = [False] * len(b_keep)
+    _myers(
+        [a_ids[i] for i in a_keep], 0, len(a_keep),
+        [b_ids[j] for j in b_keep], 0, len(b_keep),
+        a_kept_changed, b_kept_changed,
+    )
+    a_changed = [True] * len(a)
+    b_changed = [True] * len(b)
+    for i, changed in zip(a_keep, a_kept_changed):
+        a_changed[i] = changed
+    for j, changed in zip(b_keep, b_kept_changed):
+        b_changed[j] = changed
+
+    ops = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if i < len(a) and a_changed[i]:
+            ops.append((b"-", i, j, a[i]))
+            i += 1
+        elif j < len(b) and b_changed[j]:
+            ops.append((b"+", i, j, b[j]))
+            j += 1
+        else:
+            ops.append((b" ", i, j, a[i]))
+            i += 1
+            j += 1
+    return ops
+
+
+def _myers(a, a_lo, a_hi, b, b_lo, b_hi, a_changed, b_changed):
+    """
+    Mark the lines of a[a_lo:a_hi] and b[b_lo:b_hi] that are not part of a
+    longest common subsequence, using the linear space divide and conquer
+    variant of Myers' algorithm.
+    """
+    while True:
+        # Trim common prefix and suffix
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
 
+        if a_lo == a_hi:
+            for j in range(b_lo, b_hi):
+                b_changed[j] = True
+            return
+        if b_lo == b_hi:
+            for i in range(a_lo, a_hi):
+                a_changed[i] = True
+            return
+
+        x_start, y_start, x_end, y_end = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        _myers(a, a_lo, x_start, b, b_lo, y_start, a_changed, b_changed)
+        # Tail call on the second half
+        a_lo, b_lo = x_end, y_end
+
+
+def _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi) -> Tuple[int, int, int, int]:
+    """
+    Find the middle snake of an optimal edit path, return its absolute
+    (x start, y start, x end, y end).
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    # Furthest x reached on each diagonal k = x - y, going forwards, and
+    # going backwards in reversed coordinates
+    v_forward = [0] * (2 * offset + 1)
+    v_backward = [0] * (2 * offset + 1)
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v_forward[offset + k - 1] < v_forward[offset + k + 1]):
+                x = v_forward[offset + k + 1]
+            else:
+                x = v_forward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v_forward[offset + k] = x
+            # The same diagonal, going backwards, is delta - k
+            if odd and -(d - 1) <= delta - k <= d - 1:
+                if x + v_backward[offset + delta - k] >= n:
+                    return a_lo + x_start, b_lo + y_start, a_lo + x, b_lo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v_backward[offset + k - 1] < v_backward[offset + k + 1]):
+                x = v_backward[offset + k + 1]
+            else:
+                x = v_backward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            v_backward[offset + k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + v_forward[offset + delta - k] >= n:
+                    return a_hi - x, b_hi - y, a_hi - x_start, b_hi - y_start
+
+    assert False, "No middle snake found"
+
+
+def merge_trees(
+    changes: Iterable[Tuple[str, str, str, str]], conflicts: List[Tuple[str, str]] = None
+) -> Iterable[Tuple[str, str, str]]:
+    """
+    Three-way merge of (path, HEAD oid, other oid, base oid) changes, as from
+    base.iter_tree_changes, yield (path, HEAD oid, merged oid) for every path
+    the merge changes. Paths unchanged on at least one side are resolved by
+    comparing oids, only paths changed on both sides are merged line by line.
+    Binary files changed on both sides keep HEAD's version, (path, other oid)
+    of each is added to conflicts.
+    """
+    for path, o_HEAD, o_other, o_base in changes:
+        oid, conflict = merge_oids(o_HEAD, o_other, o_base)
+        if conflict and conflicts is not None:
+            conflicts.append((path, o_other))
+        if oid != o_HEAD:
+            yield path, o_HEAD, oid
+
+
+def merge_oids(o_HEAD: str, o_other: str, o_base: str) -> Tuple[str, bool]:
+    """
+    Return the oid of the merged blob, None if the path is deleted, and
+    whether the blobs could not be merged, in which case HEAD's is kept.
+    """
+    if o_HEAD == o_other or o_other == o_base:
+        return o_HEAD, False
+    if o_HEAD == o_base:
+        return o_other, False
+    merged = merge_blobs(o_HEAD, o_other, o_base)
+    if merged is None:
+        return o_HEAD, True
+    return data.hash_object(merged), False
+
+
+@trace.timed()
 def merge_blobs(o_HEAD: str, o_other: str, o_base: str) -> AnyStr:
     """
-    Return the merged content.
-    """
-    with Temp(delete=False) as f_HEAD, Temp(delete=False) as f_other,\
-        Temp(delete=False) as f_base:
-        for oid, f in ((o_HEAD, f_HEAD), (o_other, f_other), (o_base, f_base)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen(
-            ['diff3', '-m',
-                '-L', 'HEAD', f_HEAD.name,
-                '-L', 'MERGE_HEAD', f_other.name,
-                '-L', 'BASE', f_base.name,
-            ], stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate()
-            assert proc.returncode in (0, 1)
-
-    os.remove(f_HEAD.name)
-    os.remove(f_other.name)
-    os.remove(f_base.name)
-    return output
+    Return the merged content, a missing blob (None) is taken as empty.
+    Return None for binary content, conflict markers would corrupt it.
+    """
+    b_HEAD, b_other, b_base = (
+        data.get_object(oid) if oid else b"" for oid in (o_HEAD, o_other, o_base)
+    )
+    if is_binary(b_HEAD) or is_binary(b_other) or is_binary(b_base):
+        return None
+    return merge3(
+        split_lines(b_base),
+        split_lines(b_HEAD),
+        split_lines(b_other),
+    )
+
+
+@trace.timed()
+def merge3(base: List[bytes], a: List[bytes], b: List[bytes],
+           label_a=b"HEAD", label_base=b"BASE", label_b=b"MERGE_HEAD") -> bytes:
+    """
+    diff3 merge of line lists a and b from their common ancestor base. Regions
+    changed on both sides in different ways are bracketed by conflict markers,
+    same as `diff3 -m`.
+    """
+    match_a = _matching_lines(base, a)
+    match_b = _matching_lines(base, b)
+
+    out = []
+    o = i = j = 0
+    while True:
+        # Next base line kept on both sides, the region before it is unstable
+        o_next = o
+        while o_next < len(base) and not (o_next in match_a and o_next in match_b):
+            o_next += 1
+        if o_next < len(base):
+            i_next, j_next = match_a[o_next], match_b[o_next]
+        else:
+            i_next, j_next = len(a), len(b)
+
+        chunk_base, chunk_a, chunk_b = base[o:o_next], a[i:i_next], b[j:j_next]
+        if chunk_a == chunk_base or chunk_a == chunk_b:
+            out.extend(chunk_b)
+        elif chunk_b == chunk_base:
+            out.extend(chunk_a)
+        else:
+            out.append(b"<<<<<<< " + label_a + b"\n")
+            out.extend(_terminated(chunk_a))
+            out.append(b"||||||| " + label_base + b"\n")
+            out.extend(_terminated(chunk_base))
+            out.append(b"=======\n")
+            out.extend(_terminated(chunk_b))
+            out.append(b">>>>>>> " + label_b + b"\n")
+
+        if o_next == len(base):
+            return b"".join(out)
+        # The stable line itself
+        out.append(base[o_next])
+        o, i, j = o_next + 1, i_next + 1, j_next + 1
+
+
+def _matching_lines(a: List[bytes], b: List[bytes]) -> Dict[int, int]:
+    """
+    Map the index of every line of a that is kept in b to its index in b.
+    """
+    return {i: j for tag, i, j, _ in diff_lines(a, b) if tag == b" "}
+
+
+def _terminated(lines: List[bytes]) -> List[bytes]:
+    """
+    Make sure a conflict marker after lines starts on its own line.
+    """
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
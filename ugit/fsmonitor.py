@@ -0,0 +1,328 @@
+"""Filesystem monitor daemon, and its client used by write_tree.
+
+'ugit fsmonitor' runs in the foreground at the top of a workspace and records
+the paths that change, with inotify on Linux and by rescanning the workspace
+otherwise. Clients connect to '.ugit/fsmonitor.sock' and send the token of
+their last query; the daemon answers with a new token and the paths changed
+since the old one, so status only examines those paths.
+
+Protocol, one query per connection:
+    client: "query <token>\\n", '-' as token for a first query
+    daemon: "<new token>\\n" then either "*" when the client must scan the
+            whole workspace, or the changed paths separated by NUL bytes
+
+A token is "<epoch>:<sequence>". The epoch changes whenever the daemon starts
+or loses track of changes (queue overflow, a directory renamed), which
+invalidates all earlier tokens.
+"""
+import os
+
+from typing import Dict, Iterable, Set, Tuple
+
+from . import data, trace
+
+# Seconds between two scans of the polling monitor
+DEFAULT_POLL_INTERVAL = 2.0
+# Seconds a client waits for the daemon before scanning by itself
+CLIENT_TIMEOUT = 5.0
+_SKIPPED = {".ugit", ".git"}
+
+
+def socket_path() -> str:
+    return f"{data.GIT_DIR}/fsmonitor.sock"
+
+
+@trace.timed()
+def query(token: str) -> Tuple[str, Set[str]]:
+    """
+    Ask the daemon what changed since token. Return (new token, changed
+    paths), the paths being None if the whole workspace must be scanned, and
+    (None, None) if no daemon is running.
+    """
+    if not os.path.exists(socket_path()):
+        return None, None
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CLIENT_TIMEOUT)
+            client.connect(socket_path())
+            client.sendall(f"query {token or '-'}\n".encode())
+            client.shutdown(socket.SHUT_WR)
+            response = b"".join(iter(lambda: client.recv(data.CHUNK_SIZE), b""))
+    except OSError:
+        # A stale socket of a daemon that died, or a daemon that hangs
+        return None, None
+
+    new_token, _, body = response.decode().partition("\n")
+    if not new_token:
+        return None, None
+    if body == "*":
+        return new_token, None
+    return new_token, set(filter(None, body.split("\0")))
+
+
+class _Changes:
+    """
+    Changed paths, each with the sequence number of its last change.
+    """
+
+    def __init__(self):
+        self.epoch = f"{os.getpid()}-{int.from_bytes(os.urandom(4), 'big'):08x}"
+        self.sequence = 0
+        self.paths: Dict[str, int] = {}
+
+    def reset(self):
+        self.__init__()
+
+    def add(self, paths: Iterable[str]):
+        self.sequence += 1
+        for path in paths:
+            self.paths[path] = self.sequence
+
+    def answer(self, token: str) -> str:
+        epoch, _, sequence = token.partition(":")
+        new_token = f"{self.epoch}:{self.sequence}"
+        if epoch != self.epoch:
+            return f"{new_token}\n*"
+        since = int(sequence)
+        changed = [path for path, seq in self.paths.items() if seq > since]
+        return f"{new_token}\n" + "\0".join(changed)
+
+
+def _walk(top: str = "."):
+    """
+    os.walk of the workspace, without the repositories.
+    """
+    for root, dirnames, filenames in os.walk(top):
+        dirnames[:] = [name for name in dirnames if name not in _SKIPPED]
+        yield root, dirnames, filenames
+
+
+def _relative(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+class _PollingWatcher:
+    """
+    Find changes by comparing the stat information of every path with the
+    previous scan. Works everywhere, at the cost of a scan per query.
+    """
+
+    def __init__(self, changes: _Changes):
+        self.changes = changes
+        self.snapshot = self._scan()
+
+    def fileno(self):
+        return None
+
+    @staticmethod
+    def _scan() -> Dict[str, tuple]:
+        snapshot = {}
+        for root, dirnames, filenames in _walk():
+            for names, is_dir in ((dirnames, True), (filenames, False)):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.lstat(path)
+                    except FileNotFoundError:
+                        continue
+                    # The entries of a directory are compared anyway, its own
+                    # mtime would only make the whole directory look changed
+                    info = (st.st_mode, st.st_ino)
+                    if not is_dir:
+                        info += (st.st_size, st.st_mtime_ns)
+                    snapshot[_relative(path)] = info
+        return snapshot
+
+    def update(self):
+        snapshot = self._scan()
+        old = self.snapshot
+        changed = {path for path, info in snapshot.items() if old.get(path) != info}
+        changed.update(path for path in old if path not in snapshot)
+        self.snapshot = snapshot
+        if changed:
+            self.changes.add(changed)
+
+
+class _InotifyWatcher:
+    """
+    Record the events of an inotify watch on every directory of the workspace.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+
+    def __init__(self, changes: _Changes):
+        import ctypes
+        import ctypes.util
+        import struct
+
+        self.changes = changes
+        self._event = struct.Struct("iIII")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self._dirs: Dict[int, str] = {}
+        self._watch_tree(".")
+
+    def fileno(self):
+        return self._fd
+
+    def _watch(self, directory: str):
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self._fd, directory.encode(), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+        self._dirs[wd] = _relative(directory)
+
+    def _watch_tree(self, top: str) -> Iterable[str]:
+        """
+        Watch top and its subdirectories, return the paths found beneath top.
+        """
+        found = []
+        for root, dirnames, filenames in _walk(top):
+            self._watch(root)
+            found.extend(_relative(os.path.join(root, name)) for name in dirnames + filenames)
+        return found
+
+    def _restart(self):
+        """
+        Changes were lost, start over with a new epoch.
+        """
+        for wd in list(self._dirs):
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._dirs = {}
+        self.changes.reset()
+        self._watch_tree(".")
+
+    def update(self):
+        """
+        Record the queued events.
+        """
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = self._event.unpack_from(buf, pos)
+                pos += self._event.size
+                name = buf[pos:pos + length].rstrip(b"\0").decode(errors="surrogateescape")
+                pos += length
+                if mask & self.IN_Q_OVERFLOW or (
+                    mask & self.IN_ISDIR and mask & (self.IN_MOVED_FROM | self.IN_MOVED_TO)
+                ):
+                    # Paths under a renamed directory are unknown, and an
+                    # overflow loses events
+                    self._restart()
+                    return
+                if mask & self.IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = name if directory == "." else f"{directory}/{name}"
+                if path in _SKIPPED:
+                    continue
+                changed.add(path)
+                if mask & self.IN_ISDIR and mask & self.IN_CREATE:
+                    # Files created before the watch was added have no event
+                    changed.update(self._watch_tree(path))
+        if changed:
+            self.changes.add(changed)
+
+
+def run(poll: bool = False, interval: float = DEFAULT_POLL_INTERVAL):
+    """
+    Serve queries until stopped, from the top of the workspace.
+    """
+    import select
+    import socket
+
+    changes = _Changes()
+    watcher = None
+    if not poll:
+        try:
+            watcher = _InotifyWatcher(changes)
+        except (OSError, AttributeError, TypeError):
+            # No inotify on this platform, or out of watches
+            watcher = None
+    if watcher is None:
+        watcher = _PollingWatcher(changes)
+    print(f"Watching with {'inotify' if watcher.fileno() is not None else 'polling'}", flush=True)
+
+    path = socket_path()
+    if os.path.exists(path):
+        os.remove(path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        try:
+            while _serve_once(server, watcher, changes, interval, select):
+                pass
+        finally:
+            os.remove(path)
+
+
+def _serve_once(server, watcher, changes: _Changes, interval: float, select) -> bool:
+    """
+    Wait for events or a query and handle them, return False to stop.
+    """
+    waiting = [server] + ([watcher] if watcher.fileno() is not None else [])
+    ready, _, _ = select.select(waiting, [], [], interval)
+    if watcher in ready or watcher.fileno() is None:
+        watcher.update()
+    if server not in ready:
+        return True
+
+    connection, _ = server.accept()
+    with connection:
+        connection.settimeout(CLIENT_TIMEOUT)
+        request = b"".join(iter(lambda: connection.recv(data.CHUNK_SIZE), b"")).decode()
+        command, _, token = request.strip().partition(" ")
+        if command == "stop":
+            connection.sendall(b"stopping\n")
+            return False
+        # Everything that happened before the query must be in the answer
+        watcher.update()
+        connection.sendall(changes.answer(token).encode())
+    return True
+
+
+def stop() -> bool:
+    """
+    Stop the daemon, return False if none was running.
+    """
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CLIENT_TIMEOUT)
+            client.connect(socket_path())
+            client.sendall(b"stop\n")
+            client.shutdown(socket.SHUT_WR)
+            client.recv(data.CHUNK_SIZE)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,126 @@
+"""Garbage collection of the object database.
+
+Objects reachable from a ref (including HEAD and MERGE_HEAD) or from a tree
+cached in the index are kept. Unreachable loose objects are removed once
+they are older than the grace period, which protects objects that a
+concurrent command has written but not referenced yet.
+"""
+import os
+import time
+
+from collections import namedtuple
+from typing import Iterable, Set, Tuple
+
+from . import data, base, commit_graph, index, pack, trace
+
+# Unreachable objects younger than this are kept, unless set by 'gc.pruneGrace'
+DEFAULT_GRACE = 14 * 24 * 60 * 60
+
+GcResult = namedtuple("GcResult", ["reachable", "pruned", "size_before", "size_after"])
+
+
+def get_grace() -> int:
+    return int(data.get_config("gc.pruneGrace", DEFAULT_GRACE))
+
+
+def _iter_roots() -> Iterable[Tuple[str, str]]:
+    """
+    Yield (kind, oid) of everything that keeps objects alive.
+    """
+    for _, ref in data.iter_refs():
+        yield "commit", ref.value
+    # The next write_tree reuses cached trees without looking at their objects
+    for cached in index.read_index().trees.values():
+        yield "tree", cached.oid
+
+
+@trace.timed()
+def iter_reachable() -> Iterable[str]:
+    """
+    Yield every reachable oid once. Commits and trees are read one at a time,
+    of a blob only the start is read, to find the chunks of chunked blobs.
+    """
+    seen: Set[str] = set()
+    commits = []
+    trees = []
+    for kind, oid in _iter_roots():
+        (commits if kind == "commit" else trees).append(oid)
+
+    for oid in base.iter_commits_and_parents(commits):
+        seen.add(oid)
+        yield oid
+        trees.append(base.get_commit(oid).tree)
+
+    # Depth first, so the stack only holds the pending entries of one path
+    while trees:
+        oid = trees.pop()
+        if oid in seen:
+            continue
+        seen.add(oid)
+        yield oid
+        for type_, entry_oid, _ in base._iter_tree_entries(oid):
+            if type_ == "tree":
+                trees.append(entry_oid)
+            elif entry_oid not in seen:
+                seen.add(entry_oid)
+                yield entry_oid
+                # The chunks of a chunked blob are blobs of their own
+                for chunk in data.get_chunks(entry_oid) or ():
+                    if chunk not in seen:
+                        seen.add(chunk)
+                        yield chunk
+
+
+def _store_size() -> int:
+    """
+    Disk usage of the object database, small loose objects take a whole block each.
+    """
+    size = 0
+    for root, _, filenames in os.walk(f"{data.GIT_DIR}/objects"):
+        for filename in filenames:
+            size += os.lstat(f"{root}/{filename}").st_blocks * 512
+    return size
+
+
+def _remove_stale_temp_files(expire: float):
+    """
+    Remove temporary files left behind by interrupted object and pack writes.
+    """
+    for root, _, filenames in os.walk(f"{data.GIT_DIR}/objects"):
+        for filename in filenames:
+            path = f"{root}/{filename}"
+            if filename.startswith(("tmp_obj_", "tmp_pack_")) and os.lstat(path).st_mtime < expire:
+                os.remove(path)
+
+
+@trace.timed()
+def gc(grace: int = None, repack: bool = False) -> GcResult:
+    """
+    Prune unreachable loose objects older than grace seconds, and with repack,
+    pack the reachable objects into a single pack. Packed objects that are
+    unreachable are only dropped by a repack, if their pack is older than grace.
+    """
+    if grace is None:
+        grace = get_grace()
+    expire = time.time() - grace
+    size_before = _store_size()
+
+    reachable = set(iter_reachable())
+
+    pruned = 0
+    for oid in list(data.iter_loose_objects()):
+        if oid in reachable:
+            continue
+        mtime = data.loose_object_mtime(oid)
+        if mtime is not None and mtime < expire:
+            data.remove_loose_object(oid)
+            pruned += 1
+    _remove_stale_temp_files(expire)
+
+    if repack:
+        pack.repack(reachable.union(pack.iter_packed_oids(newer_than=expire)))
+
+    # Drop pruned commits from the commit-graph
+    commit_graph.rebuild(ref.value for _, ref in data.iter_refs())
+
+    return GcResult(len(reachable), pruned, size_before, _store_size())
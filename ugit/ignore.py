@@ -0,0 +1,189 @@
+"""Gitignore-style patterns that keep files out of the snapshots.
+
+Patterns are read from a '.ugitignore' file in any directory of the
+workspace, where they apply to the paths beneath that directory, and from
+'.ugit/info/exclude' for the whole repository. They follow the gitignore
+syntax: '#' comments, '!' to re-include, a trailing '/' to match only
+directories, a '/' elsewhere to anchor the pattern to the directory of the
+file, and '*', '?', '[...]', '**' wildcards. Deeper files take precedence,
+and within a file the last matching pattern wins.
+"""
+import os
+import re
+
+from collections import namedtuple
+from typing import Dict, List
+
+from . import data
+
+IGNORE_FILE = ".ugitignore"
+
+# pattern is the line as written, regex matches paths relative to the
+# directory of source, the file the pattern comes from
+Rule = namedtuple("Rule", ["pattern", "regex", "negate", "dir_only", "source", "line"])
+
+# Never tracked, whatever the patterns say
+_ALWAYS_IGNORED = {
+    name: Rule(name, re.escape(name), False, False, None, None) for name in (".ugit", ".git")
+}
+
+
+def _translate(pattern: str) -> str:
+    """
+    Translate a glob pattern to a regex, '*' and '?' never match a '/'.
+    """
+    result = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if pattern[i:i + 1] == "*" and (i == 1 or pattern[i - 2] == "/"):
+                if i + 1 == n:
+                    # Trailing '**', everything inside
+                    result.append(".*")
+                    i += 1
+                    continue
+                if pattern[i + 1] == "/":
+                    # '**/', zero or more directories
+                    result.append("(?:.*/)?")
+                    i += 2
+                    continue
+            result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            # A ']' right after '[' or '[!' belongs to the set
+            start = i + 1 if pattern[i:i + 1] == "!" else i
+            end = pattern.find("]", start + 1 if pattern[start:start + 1] == "]" else start)
+            if end == -1:
+                result.append(re.escape(c))
+                continue
+            chars = pattern[start:end].replace("\\", "\\\\").replace("^", "\\^")
+            result.append(f"[{'^' if start > i else ''}{chars}]")
+            i = end + 1
+        elif c == "\\" and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+
+def parse_patterns(text: str, source: str = None) -> List[Rule]:
+    rules = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line or line.startswith("#"):
+            continue
+        # Trailing spaces are dropped, unless escaped with a backslash
+        pattern = line.rstrip(" ")
+        if pattern.endswith("\\") and len(pattern) < len(line):
+            pattern += " "
+        stripped = pattern
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            continue
+        # A pattern with a '/' is relative to its file, otherwise it matches a
+        # name at any depth
+        anchored = "/" in pattern
+        regex = _translate(pattern.lstrip("/"))
+        if not anchored:
+            regex = f"(?:.*/)?{regex}"
+        rules.append(Rule(stripped, regex, negate, dir_only, source, number))
+    return rules
+
+
+class _Patterns:
+    """
+    The rules of one file compiled into a single regex per kind of entry. The
+    alternatives are in reverse order so the last matching rule wins.
+    """
+
+    __slots__ = ("_files", "_dirs")
+
+    def __init__(self, rules: List[Rule]):
+        self._files = self._compile([rule for rule in rules if not rule.dir_only])
+        self._dirs = self._compile(rules)
+
+    @staticmethod
+    def _compile(rules: List[Rule]):
+        if not rules:
+            return None, ()
+        ordered = rules[::-1]
+        return re.compile("|".join(f"({rule.regex})" for rule in ordered)), ordered
+
+    def match(self, path: str, is_dir: bool) -> Rule:
+        regex, ordered = self._dirs if is_dir else self._files
+        if regex is None:
+            return None
+        match = regex.fullmatch(path)
+        return match and ordered[match.lastindex - 1]
+
+
+def _read_patterns(path: str) -> _Patterns:
+    try:
+        with open(path) as f:
+            rules = parse_patterns(f.read(), path)
+    except FileNotFoundError:
+        return None
+    return _Patterns(rules) if rules else None
+
+
+class Ignore:
+    """
+    Decide which workspace paths (relative, '/' separated) are ignored.
+    Pattern files are read and compiled the first time their directory is
+    consulted, so make a new one for every walk of the workspace.
+    """
+
+    def __init__(self):
+        # directory ('' for the root) -> its compiled '.ugitignore', None if absent
+        self._patterns: Dict[str, _Patterns] = {}
+        self._exclude = _read_patterns(f"{data.GIT_DIR}/info/exclude")
+
+    def _get_patterns(self, directory: str) -> _Patterns:
+        try:
+            return self._patterns[directory]
+        except KeyError:
+            path = f"{directory}/{IGNORE_FILE}" if directory else IGNORE_FILE
+            patterns = self._patterns[directory] = _read_patterns(path)
+            return patterns
+
+    def match(self, path: str, is_dir: bool) -> Rule:
+        """
+        Return the rule that decides about path, None if no pattern matches.
+        The parent directories are not checked, walks prune them instead.
+        """
+        parts = path.split("/")
+        rule = _ALWAYS_IGNORED.get(parts[-1])
+        if rule is not None:
+            return rule
+        for i in range(len(parts) - 1, -1, -1):
+            patterns = self._get_patterns("/".join(parts[:i]))
+            if patterns is not None:
+                rule = patterns.match("/".join(parts[i:]), is_dir)
+                if rule is not None:
+                    return rule
+        if self._exclude is not None:
+            return self._exclude.match(path, is_dir)
+        return None
+
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        rule = self.match(path, is_dir)
+        return rule is not None and not rule.negate
+
+    def check(self, path: str, is_dir: bool) -> Rule:
+        """
+        Like match, but a path inside an ignored directory is ignored by the
+        rule of that directory.
+        """
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            rule = self.match("/".join(parts[:i]), True)
+            if rule is not None and not rule.negate:
+                return rule
+        return self.match(path, is_dir)
@@ -0,0 +1,177 @@
+"""Stat cache of the working directory, saved as '.ugit/index'.
+
+Every entry remembers the stat information of a file at the time it was
+hashed, so a later walk can reuse the oid without reading the file again.
+The index also caches the tree oid of every directory (cache-tree), which
+stays valid until an entry beneath that directory changes, and the token of
+the last query to the filesystem monitor.
+"""
+import os
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from . import data, trace
+
+IndexEntry = namedtuple("IndexEntry", ["oid", "size", "mtime_ns", "ino"])
+# count is the number of files and directories beneath the directory when
+# the tree was written
+CachedTree = namedtuple("CachedTree", ["oid", "count"])
+
+
+class Index:
+    """
+    Map from workspace path (relative, '/' separated) to IndexEntry,
+    and from directory ('.' for the root) to CachedTree.
+    """
+
+    __slots__ = ("entries", "trees", "mtime_ns", "fsmonitor_token", "changed")
+
+    def __init__(self, entries=None, trees=None, mtime_ns: int = 0, fsmonitor_token: str = None):
+        self.entries = entries if entries is not None else {}
+        self.trees = trees if trees is not None else {}
+        # The entries reflect the workspace as of this fsmonitor token
+        self.fsmonitor_token = fsmonitor_token
+        # mtime of the index file when it was loaded, used to detect racy entries
+        self.mtime_ns = mtime_ns
+        self.changed = False
+
+    def lookup(self, path: str, st: os.stat_result) -> str:
+        """
+        Return the cached oid of path if the stat info still matches, None otherwise.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        if (entry.size, entry.mtime_ns, entry.ino) != (
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ino,
+        ):
+            return None
+        if entry.mtime_ns >= self.mtime_ns:
+            # Racy entry: the file was modified in the same timestamp tick as
+            # the index was written, so a later change may keep the same stat.
+            return None
+        return entry.oid
+
+    def update(self, path: str, st: os.stat_result, oid: str):
+        entry = IndexEntry(oid, st.st_size, st.st_mtime_ns, st.st_ino)
+        old = self.entries.get(path)
+        if old != entry:
+            self.entries[path] = entry
+            self.changed = True
+            if old is None or old.oid != oid:
+                self.invalidate_tree(path)
+        elif entry.mtime_ns >= self.mtime_ns:
+            # A racy entry confirmed by its content, the next index write
+            # makes it clean
+            self.changed = True
+
+    def remove(self, path: str):
+        if self.entries.pop(path, None) is not None:
+            self.changed = True
+            self.invalidate_tree(path)
+
+    def get_tree(self, directory: str, count: int) -> str:
+        """
+        Return the cached tree oid of directory, None if it has been invalidated
+        or files or directories were removed beneath it since (count differs).
+        """
+        cached = self.trees.get(directory)
+        if cached is None or cached.count != count:
+            return None
+        return cached.oid
+
+    def set_tree(self, directory: str, oid: str, count: int):
+        tree = CachedTree(oid, count)
+        if self.trees.get(directory) != tree:
+            self.trees[directory] = tree
+            self.changed = True
+
+    def invalidate_tree(self, path: str):
+        """
+        Drop the cached tree of every directory containing path.
+        """
+        while path != ".":
+            path = os.path.dirname(path) or "."
+            if self.trees.pop(path, None) is not None:
+                self.changed = True
+
+    def set_fsmonitor_token(self, token: str):
+        if self.fsmonitor_token != token:
+            self.fsmonitor_token = token
+            self.changed = True
+
+    def retain(self, paths):
+        """
+        Drop every entry whose path is not in paths.
+        """
+        for path in set(self.entries) - set(paths):
+            self.remove(path)
+
+
+def _index_path() -> str:
+    return f"{data.GIT_DIR}/index"
+
+
+@trace.timed()
+def read_index() -> Index:
+    path = _index_path()
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return Index()
+
+    entries = {}
+    trees = {}
+    fsmonitor_token = None
+    for line in lines:
+        type_, rest = line.split(" ", 1)
+        if type_ == "blob":
+            oid, size, mtime_ns_, ino, name = rest.split(" ", 4)
+            entries[name] = IndexEntry(oid, int(size), int(mtime_ns_), int(ino))
+        elif type_ == "tree":
+            oid, count, name = rest.split(" ", 2)
+            trees[name] = CachedTree(oid, int(count))
+        elif type_ == "fsmonitor":
+            fsmonitor_token = rest
+        else:
+            assert False, f"Unknown index entry {type_}"
+    return Index(entries, trees, mtime_ns, fsmonitor_token)
+
+
+@trace.timed()
+def write_index(index: Index):
+    """
+    Atomically replace the index file with the content of index.
+    An entry whose file was modified as late as the index is written is saved
+    with an invalid size, so the file is hashed again rather than trusted.
+    """
+    path = _index_path()
+    tmp = f"{path}.lock"
+    with open(tmp, "w") as f:
+        written_ns = os.fstat(f.fileno()).st_mtime_ns
+        for name, entry in sorted(index.entries.items()):
+            size = -1 if entry.mtime_ns >= written_ns else entry.size
+            f.write(f"blob {entry.oid} {size} {entry.mtime_ns} {entry.ino} {name}\n")
+        for name, tree in sorted(index.trees.items()):
+            f.write(f"tree {tree.oid} {tree.count} {name}\n")
+        if index.fsmonitor_token:
+            f.write(f"fsmonitor {index.fsmonitor_token}\n")
+    os.replace(tmp, path)
+    index.mtime_ns = os.stat(path).st_mtime_ns
+    index.changed = False
+
+
+@contextmanager
+def get_index():
+    """
+    Load the index, and write it back on exit if it was modified.
+    """
+    index = read_index()
+    yield index
+    if index.changed:
+        write_index(index)
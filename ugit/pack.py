@@ -0,0 +1,493 @@
+"""Pack many objects into a single file, with delta compression between similar objects.
+
+A pack 'pack-<sha>.pack' is laid out as:
+    header: b"UPCK", version, object count
+    entries: kind, [base oid if delta], compressed length, zlib(payload)
+    trailer: sha1 of everything above
+
+and comes with a 'pack-<sha>.idx', which is memory-mapped and binary-searched:
+    header: b"UIDX", version
+    fan-out: 256 cumulative counts by the first byte of oid
+    oids: sorted 20-byte oids
+    offsets: 8-byte offset of each oid's entry in the pack
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from typing import Iterable, List
+
+from . import data, trace
+
+PACK_MAGIC = b"UPCK"
+IDX_MAGIC = b"UIDX"
+VERSION = 1
+
+_PACK_HEADER = struct.Struct(">4sII")
+_IDX_HEADER = struct.Struct(">4sI")
+_FANOUT = struct.Struct(">256I")
+_OFFSET = struct.Struct(">Q")
+_ENTRY_HEADER = struct.Struct(">BQ")
+
+KIND_FULL = 0
+KIND_DELTA = 1
+
+# How many previous objects are tried as a delta base
+DELTA_WINDOW = 10
+# Maximum length of a delta chain, which bounds the cost of reading an object
+MAX_DELTA_DEPTH = 50
+# Larger objects are stored without attempting a delta
+MAX_DELTA_SIZE = 1 << 24
+
+
+def _pack_dir() -> str:
+    return f"{data.GIT_DIR}/objects/pack"
+
+
+class Pack:
+    """
+    A read-only pack, with both the pack and the index memory-mapped.
+    """
+
+    __slots__ = ("name", "count", "_idx", "_pack", "_fanout")
+
+    def __init__(self, name: str):
+        self.name = name
+        with open(f"{name}.idx", "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(f"{name}.pack", "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = _IDX_HEADER.unpack_from(self._idx, 0)
+        assert magic == IDX_MAGIC and version == VERSION, f"Bad pack index {name}.idx"
+        self._fanout = _FANOUT.unpack_from(self._idx, _IDX_HEADER.size)
+        self.count = self._fanout[-1]
+
+    def _oid_at(self, i: int) -> bytes:
+        start = _IDX_HEADER.size + _FANOUT.size + 20 * i
+        return self._idx[start:start + 20]
+
+    def _offset_at(self, i: int) -> int:
+        start = _IDX_HEADER.size + _FANOUT.size + 20 * self.count + _OFFSET.size * i
+        return _OFFSET.unpack_from(self._idx, start)[0]
+
+    def find(self, oid: str) -> int:
+        """
+        Return the offset of oid in the pack, None if not in this pack.
+        """
+        key = bytes.fromhex(oid)
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._oid_at(mid)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return self._offset_at(mid)
+        return None
+
+    def iter_oids(self) -> Iterable[str]:
+        for i in range(self.count):
+            yield self._oid_at(i).hex()
+
+    def read(self, offset: int, depth: int = 0) -> bytes:
+        """
+        Return the object (type00data) stored at offset, resolving deltas.
+        """
+        kind, length = _ENTRY_HEADER.unpack_from(self._pack, offset)
+        offset += _ENTRY_HEADER.size
+        if kind == KIND_FULL:
+            return zlib.decompress(self._pack[offset:offset + length])
+
+        assert kind == KIND_DELTA, f"Unknown pack entry kind {kind}"
+        assert depth <= MAX_DELTA_DEPTH, "Delta chain too deep"
+        base_oid = self._pack[offset:offset + 20].hex()
+        offset += 20
+        base_offset = self.find(base_oid)
+        assert base_offset is not None, f"Missing delta base {base_oid}"
+        base = _delta_base_cache.get((self.name, base_offset))
+        if base is None:
+            base = self.read(base_offset, depth + 1)
+            _delta_base_cache.put((self.name, base_offset), base)
+        delta = zlib.decompress(self._pack[offset:offset + length])
+        return apply_delta(base, delta)
+
+    def iter_read(self, offset: int) -> Iterable[bytes]:
+        """
+        Stream the object stored at offset. Entries stored whole are decompressed
+        chunk by chunk, deltas are small enough to be resolved in memory.
+        """
+        kind, length = _ENTRY_HEADER.unpack_from(self._pack, offset)
+        if kind != KIND_FULL:
+            yield self.read(offset)
+            return
+        start = offset + _ENTRY_HEADER.size
+        view = memoryview(self._pack)
+        try:
+            yield from data.iter_decompressed(
+                view[i:min(i + data.CHUNK_SIZE, start + length)]
+                for i in range(start, start + length, data.CHUNK_SIZE)
+            )
+        finally:
+            view.release()
+
+    def close(self):
+        self._idx.close()
+        self._pack.close()
+
+
+class _BaseCache:
+    """
+    Keep the most recently resolved delta bases, so reading siblings of a
+    delta chain does not resolve the whole chain again.
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            while self.items and self.size + len(value) > self.max_bytes:
+                # dicts keep insertion order, so this evicts the oldest entry
+                old = self.items.pop(next(iter(self.items)))
+                self.size -= len(old)
+            self.items[key] = value
+            self.size += len(value)
+
+
+_delta_base_cache = _BaseCache()
+
+# Packs loaded for _packs_git_dir
+_packs: List[Pack] = None
+_packs_git_dir = None
+
+
+_packs_lock = threading.Lock()
+
+
+def _get_packs(reload: bool = False) -> List[Pack]:
+    """
+    Return the packs of the repository. With reload, the pack directory is
+    listed again to find the packs added or removed since; the packs that
+    are still there are not opened again.
+    """
+    global _packs, _packs_git_dir
+    if _packs is None or reload or _packs_git_dir != data.GIT_DIR:
+        with _packs_lock:
+            names = []
+            if os.path.isdir(_pack_dir()):
+                names = [
+                    f"{_pack_dir()}/{filename[:-4]}"
+                    for filename in sorted(os.listdir(_pack_dir()))
+                    if filename.endswith(".idx")
+                ]
+            opened = {}
+            if _packs is not None and _packs_git_dir == data.GIT_DIR:
+                if [p.name for p in _packs] == names:
+                    return _packs
+                opened = {p.name: p for p in _packs}
+            # Removed packs are not closed, other threads may still be reading them,
+            # their maps are released once no longer referenced.
+            _packs = [opened.get(name) or Pack(name) for name in names]
+            _packs_git_dir = data.GIT_DIR
+    return _packs
+
+
+def read_object(oid: str, reload: bool = False) -> bytes:
+    """
+    Return the object (type00data) if it is in a pack, None otherwise.
+    """
+    for p in _get_packs(reload):
+        offset = p.find(oid)
+        if offset is not None:
+            return p.read(offset)
+    return None
+
+
+def iter_object(oid: str) -> Iterable[bytes]:
+    """
+    Return a stream of the object (type00data) if it is in a pack, None otherwise.
+    """
+    for p in _get_packs():
+        offset = p.find(oid)
+        if offset is not None:
+            return p.iter_read(offset)
+    return None
+
+
+def has_object(oid: str, reload: bool = False) -> bool:
+    return any(p.find(oid) is not None for p in _get_packs(reload))
+
+
+def freshen_object(oid: str, reload: bool = False) -> bool:
+    """
+    Set the modification time of the pack holding oid to now, so gc keeps
+    its objects for another grace period. Return whether oid is packed.
+    """
+    for p in _get_packs(reload):
+        if p.find(oid) is not None:
+            os.utime(f"{p.name}.pack")
+            return True
+    return False
+
+
+def iter_packed_oids(newer_than: float = None) -> Iterable[str]:
+    """
+    Yield the oids of all packs, or of the packs modified after newer_than.
+    """
+    for p in _get_packs(reload=True):
+        if newer_than is None or os.path.getmtime(f"{p.name}.pack") > newer_than:
+            yield from p.iter_oids()
+
+
+def _encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(buf: bytes, pos: int):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+
+_OP_INSERT = 0
+_OP_COPY = 1
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """
+    Encode target as copy and insert instructions against base.
+    Matching is done line by line, which suits both trees and text blobs.
+    """
+    index = {}
+    offset = 0
+    for line in base.splitlines(keepends=True):
+        index.setdefault(line, offset)
+        offset += len(line)
+
+    out = [_encode_varint(len(base)), _encode_varint(len(target))]
+    inserts = []
+    copy_offset = copy_length = 0
+
+    def flush_copy():
+        if copy_length:
+            out.append(bytes([_OP_COPY]))
+            out.append(_encode_varint(copy_offset))
+            out.append(_encode_varint(copy_length))
+
+    def flush_insert():
+        if inserts:
+            chunk = b"".join(inserts)
+            out.append(bytes([_OP_INSERT]))
+            out.append(_encode_varint(len(chunk)))
+            out.append(chunk)
+            inserts.clear()
+
+    for line in target.splitlines(keepends=True):
+        if copy_length and base.startswith(line, copy_offset + copy_length):
+            # continue the current copy
+            copy_length += len(line)
+            continue
+        match = index.get(line)
+        if match is None:
+            flush_copy()
+            copy_length = 0
+            inserts.append(line)
+        else:
+            flush_copy()
+            flush_insert()
+            copy_offset, copy_length = match, len(line)
+    flush_copy()
+    flush_insert()
+    return b"".join(out)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_size, pos = _decode_varint(delta, 0)
+    target_size, pos = _decode_varint(delta, pos)
+    assert base_size == len(base), "Delta base size mismatch"
+
+    out = []
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == _OP_COPY:
+            offset, pos = _decode_varint(delta, pos)
+            length, pos = _decode_varint(delta, pos)
+            out.append(base[offset:offset + length])
+        else:
+            assert op == _OP_INSERT, f"Unknown delta op {op}"
+            length, pos = _decode_varint(delta, pos)
+            out.append(delta[pos:pos + length])
+            pos += length
+    result = b"".join(out)
+    assert len(result) == target_size, "Delta result size mismatch"
+    return result
+
+
+@trace.timed()
+def write_pack(oids: Iterable[str], directory: str = None) -> str:
+    """
+    Write the given objects into a new pack, return its path without extension.
+    The pack goes to directory, the pack directory of another repository when
+    sending objects there, and to this repository's by default.
+    """
+    directory = directory or _pack_dir()
+    objects = []
+    for oid in set(oids):
+        type_, size = data.object_info(oid, raw=True)
+        objects.append((type_, size, oid))
+    # Objects of the same type and a similar size make the best delta pairs,
+    # larger ones come first so they become the bases.
+    objects.sort(key=lambda o: (o[0], -o[1], o[2]))
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_pack = f"{directory}/tmp_pack_{os.getpid()}"
+    offsets = {}
+    depths = {}
+    window = []
+
+    with open(tmp_pack, "w+b") as out:
+        out.write(_PACK_HEADER.pack(PACK_MAGIC, VERSION, len(objects)))
+        for type_, size, oid in objects:
+            offsets[oid] = out.tell()
+            if size > MAX_DELTA_SIZE:
+                _write_streamed_entry(out, oid)
+                depths[oid] = 0
+                continue
+
+            obj = data.read_object(oid)
+            best_base = best_delta = None
+            for base_type, base_oid, base_obj in window:
+                if base_type != type_ or depths[base_oid] >= MAX_DELTA_DEPTH:
+                    continue
+                delta = make_delta(base_obj, obj)
+                if len(delta) < size // 2 and (
+                    best_delta is None or len(delta) < len(best_delta)
+                ):
+                    best_base, best_delta = base_oid, delta
+
+            if best_delta is None:
+                payload = zlib.compress(obj)
+                out.write(_ENTRY_HEADER.pack(KIND_FULL, len(payload)))
+                depths[oid] = 0
+            else:
+                payload = zlib.compress(best_delta)
+                out.write(_ENTRY_HEADER.pack(KIND_DELTA, len(payload)))
+                out.write(bytes.fromhex(best_base))
+                depths[oid] = depths[best_base] + 1
+            out.write(payload)
+
+            window.append((type_, oid, obj))
+            if len(window) > DELTA_WINDOW:
+                window.pop(0)
+
+        import hashlib
+
+        out.seek(0)
+        checksum = hashlib.sha1()
+        for chunk in iter(lambda: out.read(data.CHUNK_SIZE), b""):
+            checksum.update(chunk)
+        out.write(checksum.digest())
+
+    name = f"{directory}/pack-{checksum.hexdigest()}"
+    # Packs are found through their index, which must come last
+    os.replace(tmp_pack, f"{name}.pack")
+    _write_idx(f"{name}.idx", offsets)
+    return name
+
+
+def _write_streamed_entry(out, oid: str):
+    """
+    Compress a large object into the pack chunk by chunk, then patch its length.
+    """
+    start = out.tell()
+    out.write(_ENTRY_HEADER.pack(KIND_FULL, 0))
+    compressor = zlib.compressobj()
+    length = 0
+    for chunk in data.iter_raw_object(oid):
+        compressed = compressor.compress(chunk)
+        out.write(compressed)
+        length += len(compressed)
+    compressed = compressor.flush()
+    out.write(compressed)
+    length += len(compressed)
+
+    end = out.tell()
+    out.seek(start)
+    out.write(_ENTRY_HEADER.pack(KIND_FULL, length))
+    out.seek(end)
+
+
+def _write_idx(path: str, offsets):
+    sorted_oids = sorted(offsets)
+    fanout = [0] * 256
+    for oid in sorted_oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as out:
+        out.write(_IDX_HEADER.pack(IDX_MAGIC, VERSION))
+        out.write(_FANOUT.pack(*fanout))
+        out.write(b"".join(bytes.fromhex(oid) for oid in sorted_oids))
+        out.write(b"".join(_OFFSET.pack(offsets[oid]) for oid in sorted_oids))
+    os.replace(tmp, path)
+
+
+@trace.timed()
+def repack(oids: Iterable[str] = None) -> str:
+    """
+    Pack objects (all objects by default) into a single new pack, and remove
+    the loose objects that were packed. Old packs are removed, so objects only
+    found in them are dropped unless they are part of oids.
+    Return the path of the new pack without extension, None if nothing to pack.
+    """
+    old_packs = [p.name for p in _get_packs(reload=True)]
+    loose = set(data.iter_loose_objects())
+    if oids is None:
+        oids = loose.union(iter_packed_oids())
+    oids = set(oids)
+    if not oids:
+        return None
+
+    name = write_pack(oids)
+    _get_packs(reload=True)
+
+    for old in old_packs:
+        if old != name:
+            os.remove(f"{old}.idx")
+            os.remove(f"{old}.pack")
+    for oid in loose & oids:
+        data.remove_loose_object(oid)
+    _get_packs(reload=True)
+    return name
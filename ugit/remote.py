@@ -0,0 +1,158 @@
+"""Fetch and push between repositories on the local filesystem.
+
+Only the history the other side lacks is sent: the commit walk stops at the
+commits both sides have, and a new commit contributes the trees and blobs
+that differ from its parents', so unchanged subtrees are never read. The
+objects go over in a single pack written straight into the target's pack
+directory.
+"""
+import os
+
+from typing import Dict, Iterable, List, Set
+
+from . import base, data, pack, trace
+
+REMOTE_REFS_BASE = "refs/heads/"
+LOCAL_REFS_BASE = "refs/remote/"
+
+
+def _get_branches(prefix: str = REMOTE_REFS_BASE) -> Dict[str, str]:
+    """
+    Return {branch name: oid} of the current repository.
+    """
+    return {
+        refname[len(prefix):]: ref.value
+        for refname, ref in data.iter_refs(prefix)
+        if ref.value
+    }
+
+
+def _check_repository(path: str):
+    assert os.path.isdir(f"{path}/.ugit"), f"No ugit repository at {path}"
+
+
+def _existing(oids: Iterable[str]) -> List[str]:
+    return [oid for oid in set(oids) if oid and data.object_exists(oid)]
+
+
+@trace.timed()
+def fetch(remote_path: str) -> Dict[str, str]:
+    """
+    Bring the branches of the repository at remote_path to refs/remote/,
+    return {branch: oid} of the fetched branches.
+    """
+    # Commits the remote already sent and the local branch heads it may have
+    _check_repository(remote_path)
+    haves = list(_get_branches(LOCAL_REFS_BASE).values())
+    haves += _get_branches().values()
+    pack_dir = f"{data.GIT_DIR}/objects/pack"
+
+    # The remote is only read, not even its commit-graph is updated
+    with data.change_git_dir(remote_path):
+        branches = _get_branches()
+        _send_objects(branches.values(), _existing(haves), pack_dir, update_graph=False)
+
+    transaction = data.RefTransaction()
+    for name, oid in branches.items():
+        transaction.update(f"{LOCAL_REFS_BASE}{name}", data.RefValue(symbolic=False, value=oid))
+    transaction.commit()
+    return branches
+
+
+@trace.timed()
+def push(remote_path: str, refname: str):
+    """
+    Set refname of the repository at remote_path to the local refname, which
+    must be a fast-forward of it and not the branch checked out there.
+    """
+    _check_repository(remote_path)
+    local_oid = data.get_ref(refname).value
+    assert local_oid, f"Unknown ref {refname}"
+    with data.change_git_dir(remote_path):
+        remote_branches = _get_branches()
+        remote_oid = data.get_ref(refname).value
+        remote_HEAD = data.get_ref("HEAD", deref=False)
+        pack_dir = f"{data.GIT_DIR}/objects/pack"
+
+    # Its workspace and index would not follow, the next commit there would revert the push
+    assert not (remote_HEAD.symbolic and remote_HEAD.value == refname), (
+        f"Could not push, {refname} is checked out in {remote_path}"
+    )
+
+    if remote_oid:
+        assert _is_ancestor_of(local_oid, remote_oid), "Could not push, not a fast-forward"
+    _send_objects([local_oid], _existing(remote_branches.values()), pack_dir)
+
+    with data.change_git_dir(remote_path):
+        data.update_ref(refname, data.RefValue(symbolic=False, value=local_oid))
+
+
+def _is_ancestor_of(commit: str, maybe_ancestor: str) -> bool:
+    if not data.object_exists(maybe_ancestor):
+        return False
+    return base.get_merge_base(commit, maybe_ancestor) == maybe_ancestor
+
+
+def _send_objects(
+    tips: Iterable[str], haves: List[str], pack_dir: str, update_graph: bool = True
+) -> str:
+    """
+    Pack the objects of the current repository reachable from tips and not
+    from haves into pack_dir, return the path of the pack, None if none was needed.
+    """
+    oids = list(iter_missing_objects(tips, haves, update_graph))
+    trace.count("objects sent", len(oids))
+    if not oids:
+        return None
+    return pack.write_pack(oids, pack_dir)
+
+
+@trace.timed()
+def iter_missing_objects(
+    tips: Iterable[str], haves: Iterable[str], update_graph: bool = True
+) -> Iterable[str]:
+    """
+    Yield the oids of the commits reachable from tips and not from haves, and
+    of the objects their trees add to their parents' trees.
+    """
+    seen: Set[str] = set()
+    for oid in base.iter_commits_and_parents(tips, haves, update_graph):
+        yield oid
+        commit = base.get_commit(oid)
+        parent_trees = [base.get_commit(parent).tree for parent in commit.parents]
+        for new in _iter_new_tree_objects(commit.tree, parent_trees):
+            if new not in seen:
+                seen.add(new)
+                yield new
+
+
+def _iter_new_tree_objects(tree: str, old_trees: List[str]) -> Iterable[str]:
+    """
+    Yield tree and the objects below it that are not at the same path in any
+    of old_trees. A subtree found in an old tree is skipped without being read.
+    """
+    if tree in old_trees:
+        return
+    yield tree
+    old_levels = [
+        {entry.name: entry for entry in base._iter_tree_entries(old)} for old in old_trees if old
+    ]
+    for type_, oid, name in base._iter_tree_entries(tree):
+        old_entries = [level[name] for level in old_levels if name in level]
+        if any(old.oid == oid for old in old_entries):
+            continue
+        if type_ == "blob":
+            yield oid
+            # A new version of a chunked blob only brings its new chunks
+            chunks = data.get_chunks(oid)
+            if chunks:
+                old_chunks = set()
+                for old in old_entries:
+                    if old.type_ == "blob":
+                        old_chunks.update(data.get_chunks(old.oid) or ())
+                yield from (chunk for chunk in chunks if chunk not in old_chunks)
+        elif type_ == "tree":
+            old_subtrees = [old.oid for old in old_entries if old.type_ == "tree"]
+            yield from _iter_new_tree_objects(oid, old_subtrees)
+        else:
+            assert False, f"Unknown tree entry {type_}"
@@ -0,0 +1,92 @@
+"""Sparse checkout, a workspace holding only some directories of the snapshots.
+
+The directories are listed in '.ugit/info/sparse-checkout', one path relative
+to the top of the workspace per line, with '#' comments. Everything beneath
+them is checked out; outside of them the workspace is neither written nor
+scanned, and new snapshots keep the subtrees and files of HEAD unchanged.
+Without the file, or when it lists no directory, the whole snapshot is
+checked out.
+"""
+import os
+
+from typing import Iterable, List
+
+from . import data
+
+
+def sparse_checkout_path() -> str:
+    return f"{data.GIT_DIR}/info/sparse-checkout"
+
+
+class Cone:
+    """
+    The directories of a sparse checkout, and the directories leading to them.
+    """
+
+    def __init__(self, prefixes: Iterable[str]):
+        self.prefixes = set(prefixes)
+        # Proper ancestors of the prefixes, '.' being the top of the workspace
+        self.parents = set()
+        for prefix in self.prefixes:
+            while prefix != ".":
+                prefix = os.path.dirname(prefix) or "."
+                self.parents.add(prefix)
+
+    def contains(self, path: str) -> bool:
+        """
+        Whether path is one of the directories or beneath one.
+        """
+        while True:
+            if path in self.prefixes:
+                return True
+            path, sep, _ = path.rpartition("/")
+            if not sep:
+                return False
+
+    def leads_to(self, directory: str) -> bool:
+        """
+        Whether directory is outside the cone but contains part of it.
+        """
+        return directory in self.parents
+
+
+def _normalize(prefix: str) -> str:
+    prefix = os.path.normpath(prefix.strip().strip("/")).replace(os.sep, "/")
+    assert prefix != ".." and not prefix.startswith("../"), f"{prefix} is outside the workspace"
+    return prefix
+
+
+def get_prefixes() -> List[str]:
+    """
+    Return the directories of the sparse checkout, empty if it is disabled.
+    """
+    try:
+        with open(sparse_checkout_path()) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [_normalize(line) for line in lines if line.strip() and not line.startswith("#")]
+
+
+def get_cone() -> Cone:
+    """
+    Return the cone of the sparse checkout, None if everything is checked out.
+    """
+    prefixes = get_prefixes()
+    if not prefixes or "." in prefixes:
+        return None
+    return Cone(prefixes)
+
+
+def set_prefixes(prefixes: List[str]):
+    """
+    Write the directories of the sparse checkout, none disables it.
+    """
+    path = sparse_checkout_path()
+    if not prefixes:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.writelines(f"{_normalize(prefix)}\n" for prefix in prefixes)
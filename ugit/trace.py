@@ -0,0 +1,172 @@
+"""Optional tracing of where a command spends its time.
+
+Tracing is switched on by the UGIT_TRACE environment variable:
+    UGIT_TRACE=1             print a summary table to stderr on exit
+    UGIT_TRACE=<file>.json   write every timed call to file in the Chrome trace
+                             format, for chrome://tracing or ui.perfetto.dev
+
+Functions are timed with the timed() decorator and blocks of code with span(),
+while count() adds up events such as bytes hashed. When UGIT_TRACE is unset,
+timed() returns the function itself and span() a shared no-op context, so the
+only remaining cost is the flag check of count() and span().
+"""
+import atexit
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from typing import Callable, Dict
+
+_SETTING = os.environ.get("UGIT_TRACE", "")
+ENABLED = _SETTING not in ("", "0")
+CHROME_PATH = _SETTING if _SETTING.endswith(".json") else None
+
+_lock = threading.Lock()
+_start = time.perf_counter()
+# name -> [calls, seconds]
+_timings = defaultdict(lambda: [0, 0.0])
+_counters = defaultdict(int)
+# name -> function returning the value at exit, for statistics kept elsewhere
+_gauges: Dict[str, Callable[[], int]] = {}
+_events = []
+_NO_SPAN = contextlib.nullcontext()
+
+
+def _record(name: str, start: float, end: float):
+    with _lock:
+        timing = _timings[name]
+        timing[0] += 1
+        timing[1] += end - start
+        if CHROME_PATH:
+            _events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - _start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+
+def timed(name: str = None):
+    """
+    Decorator recording the calls and time of a function, named
+    'module.function' by default. Generators are timed from the call until
+    they are exhausted or closed.
+    """
+
+    def decorate(func):
+        if not ENABLED:
+            return func
+        import inspect
+
+        label = name or f"{func.__module__.rpartition('.')[2]}.{func.__qualname__}"
+
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return (yield from func(*args, **kwargs))
+                finally:
+                    _record(label, start, time.perf_counter())
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(label, start, time.perf_counter())
+
+        return wrapper
+
+    return decorate
+
+
+@contextlib.contextmanager
+def _span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, start, time.perf_counter())
+
+
+def span(name: str):
+    """
+    Context manager timing a block of code like a call to a timed function.
+    """
+    return _span(name) if ENABLED else _NO_SPAN
+
+
+def count(name: str, n: int = 1):
+    if ENABLED:
+        with _lock:
+            _counters[name] += n
+
+
+def gauge(name: str, func: Callable[[], int]):
+    """
+    Report func() under name on exit.
+    """
+    if ENABLED:
+        _gauges[name] = func
+
+
+def _values() -> Dict[str, int]:
+    values = dict(_counters)
+    for name, func in _gauges.items():
+        values[name] = func()
+    return values
+
+
+def _write_summary(out):
+    elapsed = time.perf_counter() - _start
+    out.write(f"ugit trace: {elapsed * 1000:.1f}ms in total\n")
+    out.write(f"{'calls':>9} {'total ms':>10} {'avg us':>9}  name\n")
+    for name, (calls, seconds) in sorted(_timings.items(), key=lambda item: -item[1][1]):
+        out.write(f"{calls:>9} {seconds * 1000:>10.1f} {seconds / calls * 1e6:>9.1f}  {name}\n")
+    values = _values()
+    if values:
+        out.write(f"{'count':>9}  name\n")
+        for name, value in sorted(values.items()):
+            out.write(f"{value:>9}  {name}\n")
+
+
+def _write_chrome_trace(path: str):
+    import json
+
+    events = list(_events)
+    # The counters are shown as one sample at the end of the trace
+    events.append(
+        {
+            "name": "counters",
+            "ph": "C",
+            "ts": (time.perf_counter() - _start) * 1e6,
+            "pid": os.getpid(),
+            "args": _values(),
+        }
+    )
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _report():
+    if CHROME_PATH:
+        _write_chrome_trace(CHROME_PATH)
+    else:
+        _write_summary(sys.stderr)
+
+
+if ENABLED:
+    atexit.register(_report)